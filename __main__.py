@@ -2,8 +2,27 @@
 
 # Imports
 from enum import Enum
-from helpbrowser import open_help_document
-from opensimplex import OpenSimplex
+from worldgen import MAX_SEED, SpawnTable, StructureTable, TerrainTable, WorldGenerator
+from worldstore import WorldStore
+from chunkmanager import ChunkManager
+from worldsave import SaveFile
+from worldcache import WorldCache, get_generation_key
+from renderer import Overlay, Renderer, TextCache
+from entityindex import EntityIndex
+from entitystore import AI_ANIMAL, AI_FAST_ANIMAL, EntityStore, EntityView, get_object_step
+from pathfinding import BEHAVIOURS, WANDER, FlowField
+from tilestructures import create_tile_structure, place_tile_structures
+from visibility import FieldOfView
+from minimap import Minimap
+from scheduler import SimulationScheduler
+from gameloop import FrameClock
+from profiler import FrameProfile, StartupProfile
+from helpbrowser import HelpBrowser
+from replay import InputRecorder, InputReplay, get_config_hash
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import argparse
+import hashlib
 import pygame
 import random
 import json
@@ -16,20 +35,45 @@ import traceback
 global menu_open
 global item_icon
 
-# Init pygame
-pygame.init()
+# Seed argument function
+def seed_argument(value):
+    ''' A seed from the command line, saves and world caches store it in 64 bits '''
+    seed = int(value)
+    if not 0 <= seed < MAX_SEED:
+        raise argparse.ArgumentTypeError('the seed must be between 0 and {0}'.format(MAX_SEED - 1))
+    return seed
+
+# Parse command line
+parser = argparse.ArgumentParser(description='ExploreGame')
+parser.add_argument('--seed', type=seed_argument, help='generate the world from this seed instead of a random one')
+parser.add_argument('--no-cache', action='store_true', help='always generate the world instead of using the world cache')
+parser.add_argument('--profile-startup', action='store_true', help='print how long every phase of startup took')
+parser.add_argument('--record', metavar='FILE', help='start a new world and record the keys played to FILE')
+parser.add_argument('--replay', metavar='FILE', help='play a recording back without a window as fast as possible')
+parser.add_argument('--trace', metavar='FILE', help='write the frame and turn times of a replay to FILE')
+args = parser.parse_args()
+
+# Replays have no window
+if args.replay:
+    os.environ['SDL_VIDEODRIVER'] = 'dummy'
+
+# Init pygame, only the modules the game uses
+startup_profile = StartupProfile()
+pygame.display.init()
+pygame.font.init()
 
 # Variables
 fonts = {}
 tilesets = {}
 default_font = None
 default_tileset = None
-world = []
-worldTiles = []
+worldTiles = None
 cameraFollowsPlayer = True
 oldmap = []
-worldSurface = None
+renderer = None
 worldEntities = []
+entity_index = EntityIndex()
+entity_store = EntityStore()
 menus = []
 menu_open = None
 item_icon = None
@@ -37,24 +81,48 @@ item_icon = None
 # TODO: Add keymap for config
 keymap = {}
 
+# Zoom steps of the keys that zoom the camera
+ZOOM_KEYS = {pygame.K_EQUALS: 1, pygame.K_PLUS: 1, pygame.K_KP_PLUS: 1, pygame.K_MINUS: -1, pygame.K_KP_MINUS: -1}
+
 # SpriteSheet class
 class SpriteSheet(object):
     ''' Class used to grab images out of a sprite sheet. '''
 
-    def __init__(self, file_name, tile_width, tile_height):
-        ''' Constructor. Pass in the file name of the sprite sheet. '''
+    def __init__(self, file_name, tile_width, tile_height, image=None):
+        ''' Constructor. Pass in the file name of the sprite sheet,
+            or the image when it was already loaded. '''
 
         # Set tile size
         self.tile_width = tile_width
         self.tile_height = tile_height
 
         # Load the sprite sheet.
-        self.sprite_sheet = pygame.image.load(file_name).convert()
+        self.sprite_sheet = (image or pygame.image.load(file_name)).convert()
+
+        # Image cache
+        self.images = {}
+        self.hits = 0
+        self.misses = 0
 
     def get_image(self, x, y):
-        ''' Grab a single image out of a larger spritesheet
-            Pass in the x, y location of the sprite
-            and the width and height of the sprite. '''
+        ''' Grab a single image out of the sprite sheet.
+            Images are cached, every call with the same x and y
+            returns the same converted surface. '''
+
+        key = (x, y)
+        image = self.images.get(key)
+        if image is not None:
+            self.hits += 1
+            return image
+
+        self.misses += 1
+        image = self.load_image(x, y)
+        self.images[key] = image
+        return image
+
+    def load_image(self, x, y):
+        ''' Cut a new image out of the sprite sheet
+            Pass in the x, y location of the sprite. '''
 
         # Create a new blank image
         image = pygame.Surface([self.tile_width, self.tile_height]).convert()
@@ -68,6 +136,24 @@ class SpriteSheet(object):
         # Return the image
         return image
 
+    def preload(self, coordinates):
+        ''' Load every (x, y) in coordinates into the cache '''
+        for x, y in coordinates:
+            if (x, y) not in self.images:
+                self.images[(x, y)] = self.load_image(x, y)
+
+    def get_memory_usage(self):
+        ''' Bytes used by the cached images '''
+        return sum(i.get_width() * i.get_height() * i.get_bytesize() for i in self.images.values())
+
+    def get_stats(self):
+        return {
+            'images': len(self.images),
+            'hits': self.hits,
+            'misses': self.misses,
+            'memory': self.get_memory_usage()
+        }
+
 # Camera class
 class Camera:
     def __init__(self, x=0, y=0, sx=1, sy=1):
@@ -76,6 +162,16 @@ class Camera:
         self.sx = sx
         self.sy = sy
 
+    def zoom(self, levels, step):
+        ''' Move the scale step levels in (positive) or out (negative) of the sorted zoom levels,
+            returns whether it changed '''
+        current = min(range(len(levels)), key=lambda i: abs(levels[i] - self.sx))
+        level = levels[max(0, min(current + step, len(levels) - 1))]
+        if (level, level) == (self.sx, self.sy):
+            return False
+        self.sx = self.sy = level
+        return True
+
 # Console class
 class Console:
     def print_message(self, a, b):
@@ -96,7 +192,7 @@ class Console:
 
 # Entity class
 class Entity:
-    def __init__(self, name, image, x, y, z, health, tangible):
+    def __init__(self, name, image, x, y, z, health, tangible, behaviour=WANDER):
         self.name = name
         self.image = image
         self.x = x
@@ -104,9 +200,15 @@ class Entity:
         self.z = z
         self.health = health
         self.tangible = tangible
+        self.behaviour = behaviour
 
     def take_damage(self, damage):
         self.health -= damage
+        if self.health <= 0:
+            kill_entity(self)
+
+    def move(self, dx, dy, dz=0):
+        entity_index.move(self, self.x + dx, self.y + dy, self.z + dz)
 
 # Text class
 class Text:
@@ -120,18 +222,22 @@ class Text:
         self.bg = bg
         self.x = x
         self.y = y
-        self.text_object = self.font.render(self.text, 0, self.fg, self.bg)
+        self.text_object = text_cache.render(self.font, self.text, self.fg, self.bg)
 
     def set_text(self, t):
-        self.text = t
-        self.update()
+        if t != self.text:
+            self.text = t
+            self.update()
 
     def update(self):
-        self.text_object = self.font.render(self.text, 0, self.fg, self.bg)
+        self.text_object = text_cache.render(self.font, self.text, self.fg, self.bg)
 
     def draw(self, surface, x=x, y=y):
         surface.blit(self.text_object, (x, y))
 
+    def get_rect(self):
+        return self.text_object.get_rect(topleft=(self.x, self.y))
+
 # Stats class
 class StatsObject:
     def __init__(self, health, strength, agility, dexterity, intelligence):
@@ -199,60 +305,50 @@ class Player:
         self.selected_item = selected_item
 
     def draw(self):
-        screen.blit(self.image, (screen_height / 2, screen_width / 2))
+        screen.blit(renderer.get_image(self.image), self.get_rect())
+
+    def get_rect(self):
+        return pygame.Rect(int(screen_width / 2), int(screen_height / 2), renderer.tile_width, renderer.tile_height)
 
 # Animal Entity class
 class AnimalEntity(Entity):
+    ai = AI_ANIMAL
+
     def do_turn(self):
         try:
-            m = random.randint(-1, 1)
-            dx = 0
-            dy = 0
-
-            if random.randint(0, 1):
-                dx = m
-            else:
-                dy = m
-
-            if world_height > self.y + dy > 0 and world_width > self.x + dx > 0 and player.x != dx + self.x and player.y != dy + self.y:
-                if not worldTiles[self.z][self.y + dy][self.x + dx].tangible:
-                    self.y += dy
-                    self.x += dx
+            step = get_object_step(self.ai, self.behaviour, self.x, self.y, self.z, worldTiles, (player.x, player.y, player.z), ai_random, flow_field)
+            if step is not None:
+                self.move(*step)
         except Exception as ex:
             console.warn('AnimalAI had a error: ' + str(ex))
 
 # Fast Animal Entity class
-class FastAnimalEntity(Entity):
-    def do_turn(self):
-        try:
-            dy = random.randint(-1, 1)
-            dx = random.randint(-1, 1)
-
-            if world_height > self.y + dy > 0 and config['world'][
-                'width'] > self.x + dx > 0 and player.x != dx + self.x and player.y != dy + self.y:
-                if not worldTiles[self.z][self.y + dy][self.x + dx].tangible:
-                    self.y += dy
-                    self.x += dx
-        except Exception as ex:
-            console.warn('AnimalAI had a error: ' + str(ex))
+class FastAnimalEntity(AnimalEntity):
+    ai = AI_FAST_ANIMAL
+
+# Batch Entity class
+class BatchEntity(EntityView, Entity):
+    ''' Entity stored in entity_store, its AI takes turns in batches '''
 
-# Tile class
-class Tile:
-    def __init__(self, name, x, y, z, tangible, image):
+    def __init__(self, name, image, x, y, z, health, tangible, ai, behaviour=WANDER):
+        EntityView.__init__(self, entity_store, entity_store.add(x, y, z, health, tangible, ai, behaviour))
         self.name = name
-        self.x = x
-        self.y = y
-        self.z = z
-        self.tangible = tangible
         self.image = image
 
+    def do_turn(self):
+        do_batch_turn([self])
+
 # Entity Info Indicator class
 class EntityInfoIndicator:
     def __init__(self, entity):
         self.entity = entity
         self.surface = pygame.Surface((128, 48))
+        self.key = None
 
-    def draw(self):
+    def get_key(self):
+        return id(self.entity), self.entity.name, self.entity.health, self.entity.image
+
+    def render(self):
         # Set X and Y of title
         titleX = config['indicators']['image']['padding_left'] + 32 + config['indicators']['title']['padding_left']
         titleY = config['indicators']['title']['padding_top']
@@ -269,9 +365,56 @@ class EntityInfoIndicator:
         Text(text=self.entity.name).draw(self.surface, x=titleX, y=titleY)
         Text(text='HP: {0}'.format(self.entity.health)).draw(self.surface, x=hpX, y=hpY)
 
+    def draw(self):
+        # Only render again when the entity changed
+        key = self.get_key()
+        if key != self.key:
+            self.render()
+            self.key = key
+
         # Draw to screen
         screen.blit(self.surface, (screen_height - 128, 0))
 
+    def get_rect(self):
+        return self.surface.get_rect(topleft=(screen_height - 128, 0))
+
+# Performance HUD class
+class PerformanceHud:
+    ''' FPS, the times of the frame phases and the frame counters, shown under the info text.
+        The text is only rendered again every interval milliseconds. '''
+
+    def __init__(self, profile, x, y, interval=500):
+        self.profile = profile
+        self.x = x
+        self.y = y
+        self.interval = interval
+        self.lines = []
+        self.version = 0
+        self.last_update = None
+
+    def update(self):
+        ''' Render the text again when interval has passed, returns whether it changed '''
+        now = pygame.time.get_ticks()
+        if self.last_update is not None and now - self.last_update < self.interval:
+            return False
+        self.last_update = now
+
+        lines = ['FPS {0:.1f}'.format(frame_clock.get_fps())]
+        lines += ['{0:<12} {1:6.2f} ms  p99 {2:6.2f} ms'.format(name, average * 1000, p99 * 1000) for name, average, p99 in self.profile.get_stats()]
+        lines.append('  '.join('{0} {1}'.format(name, value) for name, value in self.profile.counters.items()))
+        self.lines = [Text(text=line, font='default_small', bg=(0, 0, 0)) for line in lines]
+        self.version += 1
+        return True
+
+    def draw(self):
+        y = self.y
+        for line in self.lines:
+            line.draw(screen, x=self.x, y=y)
+            y += line.text_object.get_height()
+
+    def get_rect(self):
+        return pygame.Rect(self.x, self.y, max([line.text_object.get_width() for line in self.lines] or [0]), sum(line.text_object.get_height() for line in self.lines))
+
 # Select inventory item function
 def select_inventory_item(args):
     item = args['item']
@@ -297,6 +440,7 @@ class Menu:
         self.items = items
         self.isOpen = False
         self.selectedItem = 0
+        self.key = None
 
         s = [self.title]
         for i in self.items:
@@ -329,24 +473,37 @@ class Menu:
         else:
             menu_open = None
 
+    def get_key(self):
+        return self.title, self.selectedItem, tuple(i.text for i in self.items)
+
+    def render(self):
+        self.surface.fill(config['menu']['colors']['background'])
+
+        tt = Text(text=self.title, fg=config['menu']['colors']['title'])
+        tt.draw(surface=self.surface,
+                x=int((self.surface.get_width() - tt.text_object.get_size()[0]) / 2),
+                y=config['menu']['margin_top'])
+        for index, i in enumerate(self.items):
+            Text(text=(i.text),
+                 fg=config['menu']['colors']['selected']
+                 if self.selectedItem == index
+                 else config['menu']['colors']['default']).draw(
+                    surface=self.surface,
+                    y=default_font.get_height() * (index + 1) + config['menu']['margin_top'],
+                    x=config['menu']['margin_left'])
+
     def draw(self, target_surface):
         if self.isOpen:
-            self.surface.fill(config['menu']['colors']['background'])
-
-            tt = Text(text=self.title, fg=config['menu']['colors']['title'])
-            tt.draw(surface=self.surface,
-                    x=int((self.surface.get_width() - tt.text_object.get_size()[0]) / 2),
-                    y=config['menu']['margin_top'])
-            for i in self.items:
-                Text(text=(i.text),
-                     fg=config['menu']['colors']['selected']
-                     if self.selectedItem == self.items.index(i)
-                     else config['menu']['colors']['default']).draw(
-                        surface=self.surface,
-                        y=default_font.get_height() * (self.items.index(i) + 1) + config['menu']['margin_top'],
-                        x=config['menu']['margin_left'])
+            # Only render again when the title, items or selection changed
+            key = self.get_key()
+            if key != self.key:
+                self.render()
+                self.key = key
             target_surface.blit(self.surface, (self.x, self.y))
 
+    def get_rect(self):
+        return self.surface.get_rect(topleft=(self.x, self.y))
+
     def handle_key(self, key):
         if key == pygame.K_UP:
             self.selectedItem -= 1
@@ -376,17 +533,6 @@ class ItemHammer(Item):
 
 '''End items'''
 
-# Stairwell Tile Structure
-class StairwellTileStructure(Tile):
-    stairwell_direction = None
-
-    def setup(self):
-        self.stairwell_direction = random.randint(0, 1) if self.z != world_depth - 1 else 0
-        d = 1 if self.stairwell_direction == 1 else -1
-        osw = StairwellTileStructure(z=self.z + d, y=self.y, x=self.x, name='stairwell', tangible=self.tangible, image=self.image)
-        osw.stairwell_direction = not self.stairwell_direction
-        worldTiles[self.z + d][self.y][self.x] = osw
-        
 # Add items to classes
 items = [
     Item,
@@ -400,9 +546,10 @@ entity_classes = {
     'fast_animal': FastAnimalEntity
 }
 
-# Tile structure classes
-tile_structure_classes = {
-    'stairwell': StairwellTileStructure
+# AI types of entity classes for batch entities
+entity_ai_types = {
+    'animal': AI_ANIMAL,
+    'fast_animal': AI_FAST_ANIMAL
 }
 
 # Read json file function
@@ -412,9 +559,51 @@ def read_json_file(fn):
     f.close()
     return d
 
+# Get sprite coordinates function
+def get_sprite_coordinates(config):
+    ''' Every tileset coordinate named in the config '''
+    coordinates = set()
+    for t in config['terrain']:
+        coordinates.add((t['x'], t['y']))
+    for mob in config['mobs']:
+        coordinates.add((mob['tilex'], mob['tiley']))
+    for item in config['items'].values():
+        coordinates.add((item['icon']['x'], item['icon']['y']))
+    for tile_structure in config['tile_structures']:
+        coordinates.add((tile_structure['tile']['image']['x'], tile_structure['tile']['image']['y']))
+    coordinates.add((config['player']['image']['x'], config['player']['image']['y']))
+    return coordinates
+
 # Quit game function
 def quit_game(args={}):
     console.info('Quitting game')
+    console.info('Turns: {turn}, last turn {turn_time:.6f}s, average {average_turn_time:.6f}s'.format(**scheduler.get_stats()))
+    capture = frame_profile.flush()
+    if capture:
+        console.info('Saved frame profile to {0}'.format(capture))
+    help_browser.close()
+    cache_generated_chunks()
+    if config['world']['save']['save_on_quit'] and saving:
+        save_world()
+    if recorder is not None or replay is not None:
+        state_hash = get_state_hash()
+        console.info('State hash: {0}'.format(state_hash))
+    if recorder is not None:
+        recorder.save(state_hash)
+        console.info('Recorded {0} keys to {1}'.format(len(recorder.keys), recorder.path))
+    if replay is not None:
+        console.info('Replay: {keys} keys, {frames} frames in {time:.3f}s, frame {frame_average:.6f}s average {frame_p99:.6f}s p99, turn {turn_average:.6f}s average {turn_p99:.6f}s p99'.format(**replay.get_stats()))
+        if state_hash == replay.state_hash:
+            console.info('Replay state matches the recording')
+        else:
+            console.warn('Replay state does not match the recording, it ended in {0}'.format(replay.state_hash))
+        if replay.trace:
+            replay.save_trace(state_hash)
+    chunk_manager.close()
+    console.info('World: {chunks} chunks loaded, {generated} generated, {opened} opened, {cached} cached, {restored} restored, {unloaded} unloaded, {spilled} spilled, {memory} bytes'.format(**chunk_manager.get_stats()))
+    console.info('Chunk cache: {chunks} chunks, {hits} hits, {misses} misses, {hit_rate:.1%} hit rate'.format(**renderer.chunk_cache.get_stats()))
+    console.info('Scaled images: {images} images, {hits} hits, {misses} misses, {memory} bytes'.format(**renderer.images.get_stats()))
+    console.info('Text cache: {surfaces} surfaces, {hits} hits, {misses} misses, {hit_rate:.1%} hit rate'.format(**text_cache.get_stats()))
     exit()
 
 def restart_game(args={}):
@@ -422,10 +611,152 @@ def restart_game(args={}):
 
 # Entity collision function
 def check_entity_collision(x, y, z):
-    for i in worldEntities:
-        if i.y == y and i.x == x and i.z == z and i.tangible:
-            return True
-    return False
+    return entity_index.is_occupied(x, y, z)
+
+# Add entity function
+def add_entity(entity):
+    worldEntities.append(entity)
+    entity_index.add(entity)
+
+# Kill entity function
+def kill_entity(entity):
+    if entity in worldEntities:
+        worldEntities.remove(entity)
+        entity_index.remove(entity)
+        if isinstance(entity, BatchEntity):
+            entity_store.remove(entity.index)
+
+# Remove entities function
+def remove_entities(entities):
+    ''' Remove entities from the world without killing them '''
+    removed = set(entities)
+    for entity in entities:
+        entity_index.remove(entity)
+        if isinstance(entity, BatchEntity):
+            entity_store.remove(entity.index)
+    worldEntities[:] = [e for e in worldEntities if e not in removed]
+
+# Spawn mob function
+def spawn_mob(mob, x, y, z, health=None):
+    image = default_tileset.get_image(mob['tilex'], mob['tiley'])
+    health = mob['health'] if health is None else health
+    behaviour = BEHAVIOURS[mob.get('behaviour', 'wander')]
+    if config['world']['simulation']['batch_ai']:
+        add_entity(BatchEntity(name=mob['name'], x=x, y=y, z=z, health=health, tangible=mob['tangible'], image=image, ai=entity_ai_types[mob['type']], behaviour=behaviour))
+    else:
+        add_entity(entity_classes[mob['type']](name=mob['name'], x=x, y=y, z=z, health=health, tangible=mob['tangible'], image=image, behaviour=behaviour))
+
+# Get chunk area function
+def get_chunk_area(cx, cy):
+    ''' The x0, y0, x1, y1 of the world tiles in a chunk '''
+    cs = worldTiles.chunk_size
+    return cx * cs, cy * cs, min((cx + 1) * cs, world_width), min((cy + 1) * cs, world_height)
+
+# Populate chunk function
+def populate_chunk(cx, cy):
+    ''' Place the tile structures of a chunk that was just generated '''
+    place_tile_structures(worldTiles, seed, structure_table, config['tile_structures'], tile_structure_images, cx, cy)
+
+# Restore chunk function
+def restore_chunk(cx, cy, structures):
+    ''' Put back the tile structures of a chunk read from the save file or the cache '''
+    for name, x, y, z, state in structures:
+        tile_structure_object = create_tile_structure(tile_structures_by_name[name], x, y, z, tile_structure_images[name])
+        if name == 'stairwell':
+            tile_structure_object.stairwell_direction = state
+        worldTiles.set_structure(tile_structure_object)
+
+# Load chunk function
+def load_chunk(cx, cy, records, spawns):
+    ''' Spawn the mobs of a chunk the first time it is loaded, or put back the ones it had when it was unloaded '''
+    if records is None:
+        for mob, x, y, z in spawns or ():
+            spawn_mob(config['mobs'][mob], x, y, z)
+
+        # Remember chunks that were just generated for the cache
+        if cache_file is not None and spawns is not None:
+            uncached_chunks[(cx, cy)] = (
+                worldTiles.get_chunk(cx, cy).copy(),
+                [get_structure_record(s) for s in worldTiles.get_chunk_structures(cx, cy)],
+                [(config['mobs'][mob]['name'], x, y, z, config['mobs'][mob]['health']) for mob, x, y, z in spawns]
+            )
+        return
+
+    for name, x, y, z, health in records:
+        spawn_mob(mobs_by_name[name], x, y, z, health)
+
+# Get entity record function
+def get_entity_record(entity):
+    return entity.name, entity.x, entity.y, entity.z, entity.health
+
+# Get structure record function
+def get_structure_record(structure):
+    return (structure.name, structure.x % world_width, structure.y % world_height, structure.z % world_depth,
+            int(structure.stairwell_direction) if structure.name == 'stairwell' else -1)
+
+# Unload chunk function
+def unload_chunk(cx, cy):
+    ''' Remove the entities in a chunk, returns what is needed to put them back '''
+    x0, y0, x1, y1 = get_chunk_area(cx, cy)
+    entities = []
+    for z in range(world_depth):
+        entities.extend(entity_index.query_rect(x0, y0, x1, y1, z))
+    records = [get_entity_record(e) for e in entities]
+    remove_entities(entities)
+    return records
+
+# Save world function
+def save_world(args={}):
+    ''' Write the chunks that changed since the last save, every entity and the player to the save file '''
+    if not saving:
+        console.warn('The world is not saved while recording or replaying')
+        return
+    chunks = chunk_manager.get_unsaved_chunks()
+    entities = [get_entity_record(e) for e in worldEntities]
+    for kept in chunk_manager.kept.values():
+        entities.extend(kept['data'] or ())
+    save_file.save(seed, config['game']['version'], worldTiles, chunks, entities, (player.x, player.y, player.z), field_of_view.explored)
+    chunk_manager.unsaved.clear()
+    console.info('Saved world to {0} ({1} chunks written)'.format(save_file.path, len(chunks)))
+
+# Get state hash function
+def get_state_hash():
+    ''' Hash of the player, every entity, the tiles and tile structures of every generated chunk and the turn '''
+    state = hashlib.sha256()
+    state.update(repr((player.x, player.y, player.z, player.stats.health, player.exp, getattr(player.selected_item, 'id', None), scheduler.turn)).encode('utf-8'))
+    for entity in worldEntities:
+        state.update(repr(get_entity_record(entity)).encode('utf-8'))
+    for key, kept in sorted(chunk_manager.kept.items()):
+        state.update(repr((key, kept['data'])).encode('utf-8'))
+    for key, (tiles, structures) in sorted(chunk_manager.get_unsaved_chunks().items()):
+        state.update(repr((key, sorted(structures))).encode('utf-8'))
+        state.update(tiles.tobytes())
+    return state.hexdigest()
+
+# Cache generated chunks function
+def cache_generated_chunks():
+    ''' Add the chunks generated since the last time to the world cache '''
+    if cache_file is None or not uncached_chunks:
+        return
+    chunks = dict((key, (tiles, structures)) for key, (tiles, structures, entities) in uncached_chunks.items())
+    entities = [record for tiles, structures, entities in uncached_chunks.values() for record in entities]
+    world_cache.store(cache_file, seed, config['game']['version'], worldTiles, chunks, entities)
+    console.info('Cached {0} generated chunks in {1}'.format(len(chunks), cache_file.path))
+    uncached_chunks.clear()
+
+# Batch turn function
+def do_batch_turn(entities):
+    ''' Give entities a turn, batch entities all take their turn at once '''
+    batch = [e.index for e in entities if isinstance(e, BatchEntity)]
+    if batch:
+        moved, old_x, old_y = entity_store.step(batch, worldTiles, (player.x, player.y, player.z), batch_random, flow_field)
+        for i, x, y in zip(moved.tolist(), old_x.tolist(), old_y.tolist()):
+            entity = entity_store.views[i]
+            entity_index.relocate(entity, x, y, entity.z)
+
+    for entity in entities:
+        if not isinstance(entity, BatchEntity):
+            entity.do_turn()
 
 # Get inventory items function
 def get_inventory_menuitems():
@@ -436,18 +767,90 @@ def get_inventory_menuitems():
 
 # Open help document function
 def open_help(args):
-    open_help_document(page=args['page'], title=args['title'] if args['title'] else 'Hep[ Browser')
+    help_browser.open(page=args['page'], title=args['title'] if args['title'] else 'Help Browser')
+
+# Get target entity function
+def get_target_entity():
+    ''' The entity in front of the player '''
+    target_entity = None
+    for mob in entity_index.get_at(player.x, player.y - 1, player.z):
+        target_entity = mob
+    return target_entity
+
+# Handle key function
+def handle_key(key):
+    if menu_open:
+        if key == menu_open.toggle_key:
+            menu_open.close()
+        else:
+            menu_open.handle_key(key)
+    else:
+        if key == pygame.K_ESCAPE:  # event is escape key
+            quit_game()
+        elif key == pygame.K_UP:
+            if not worldTiles.is_tangible(int(player.x), int(player.y) - 1, int(player.z)) and not check_entity_collision(player.x, player.y - 1, player.z):
+                player.y -= 1
+        elif key == pygame.K_DOWN:
+            if not worldTiles.is_tangible(int(player.x), int(player.y) + 1, int(player.z)) and not check_entity_collision(player.x, player.y + 1, player.z):
+                player.y += 1
+        elif key == pygame.K_LEFT:
+            if not worldTiles.is_tangible(int(player.x) - 1, int(player.y), int(player.z)) and not check_entity_collision(player.x - 1, player.y, player.z):
+                player.x -= 1
+        elif key == pygame.K_RIGHT:
+            if not worldTiles.is_tangible(int(player.x) + 1, int(player.y), int(player.z)) and not check_entity_collision(player.x + 1, player.y, player.z):
+                player.x += 1
+        elif key == pygame.K_a:
+            target_entity = get_target_entity()
+            if player.selected_item and target_entity:
+                player.selected_item.on_attack(self=player.selected_item, target=target_entity)
+        elif key == pygame.K_F5:
+            save_world()
+        elif key == pygame.K_l:
+            player.z -= 1
+        elif key == pygame.K_p:
+            player.z += 1
+        tile = worldTiles.get_tile(player.x, player.y, player.z)
+        if tile.name == 'stairwell':
+            if tile.stairwell_direction == 1:
+                # BUG: Crashes when going to over max, can't solve in generator
+                player.z += 1
+            elif tile.stairwell_direction == 0:
+                player.z -= 1
+        for menu in menus:
+            if key == menu.toggle_key:
+                menu.toggle()
+
+        if menu_open == None:
+            chunk_manager.update(player.x, player.y)
+            flow_field.set_target(player.x, player.y, player.z)
+            scheduler.do_turn(worldEntities, entity_index, player.x, player.y, player.z)
+
+    if player.z >= world_depth:
+        player.z -= 1
 
 # Create console
 console = Console()
 console.info('Created console')
 
-# Load config file
+# Load config files, they are read in parallel and merged in order
+loader = ThreadPoolExecutor()
 config = {}
-for config_file in os.listdir('config'):
-    config.update(read_json_file('config/{0}'.format(config_file)))
+config_files = os.listdir('config')
+for config_file, data in zip(config_files, loader.map(read_json_file, ['config/{0}'.format(f) for f in config_files])):
+    config.update(data)
     console.info('Loaded config file: {0}'.format(config_file))
 
+# Open the recording to replay, the game is played again from its seed
+replay = None
+if args.replay:
+    replay = InputReplay(args.replay, args.trace)
+    if replay.config_hash != get_config_hash(config):
+        console.warn('{0} was recorded with another config, the replay will not match'.format(args.replay))
+
+# Start loading the tileset images while the screen and fonts are created
+tileset_images = dict((i['name'], loader.submit(pygame.image.load, 'assets/tilesets/{0}'.format(i['file']))) for i in config['tilesets'])
+startup_profile.phase('config')
+
 # Make code easier to read with config variables
 world_height = config['world']['height']
 world_width = config['world']['width']
@@ -459,9 +862,11 @@ screen_width = config['screen']['width']
 pygame.display.set_caption(config['screen']['title'] + config['game']['version'] if config['screen']['include_version_in_title'] else config['screen']['title'])
 screen = pygame.display.set_mode([screen_width, screen_height])
 console.info('Created screen')
+startup_profile.phase('display')
 
 # Create camera
-camera = Camera()
+camera = Camera(sx=config['screen']['zoom']['default'], sy=config['screen']['zoom']['default'])
+zoom_levels = sorted(config['screen']['zoom']['levels'])
 
 # Load fonts
 for i in config['fonts']:
@@ -470,94 +875,149 @@ for i in config['fonts']:
     if i['default']:
         default_font = ff
 console.info('Loaded fonts')
+startup_profile.phase('fonts')
 
 # Load tilesets
 for i in config['tilesets']:
-    ss = SpriteSheet('assets/tilesets/{0}'.format(i['file']), i['tile_width'], i['tile_height'])
+    ss = SpriteSheet('assets/tilesets/{0}'.format(i['file']), i['tile_width'], i['tile_height'], image=tileset_images[i['name']].result())
     tilesets[i['name']] = ss
     if i['default']:
         default_tileset = ss
+    if i.get('preload', False):
+        ss.preload(get_sprite_coordinates(config))
+loader.shutdown()
 console.info('Loaded tilesets')
+startup_profile.phase('tilesets')
 
-# Create text
+# Create text, rendered text is shared through the text cache
+text_cache = TextCache(config['screen']['text_cache_size'])
 infoTextObject = Text('Version {0}'.format(config['game']['version']), x=0, y=0)
 console.info('Created text objects')
 
-# Setup OpenSimplex
-seed = uuid.uuid1().int >> 64
-gen = OpenSimplex(seed=seed)
+# Open save file, a saved world of a different size is started over.
+# Recordings and replays always start a new world and never save it.
+saving = not (args.record or args.replay)
+save_file = SaveFile(config['world']['save']['file'])
+if saving and save_file.exists():
+    save_file.open()
+    if (save_file.width, save_file.height, save_file.depth, save_file.chunk_size) != (world_width, world_height, world_depth, config['world']['streaming']['chunk_size']):
+        console.warn('Saved world {0} is {1}x{2}x{3} in chunks of {4}, starting a new world'.format(save_file.path, save_file.width, save_file.height, save_file.depth, save_file.chunk_size))
+        save_file.close()
+        save_file = SaveFile(config['world']['save']['file'])
+    else:
+        if save_file.version != config['game']['version']:
+            console.warn('Saved world {0} is from version {1}'.format(save_file.path, save_file.version))
+        console.info('Opened saved world {0} ({1} chunks, {2} entities)'.format(save_file.path, len(save_file.chunks), len(save_file.entities)))
+
+# Setup world generator, the seed can be pinned on the command line or in the config
+config_seed = config['world']['seed']
+if config_seed is not None and not (isinstance(config_seed, int) and 0 <= config_seed < MAX_SEED):
+    raise ValueError('seed in config/world.json must be null or a whole number between 0 and {0}, not {1}'.format(MAX_SEED - 1, config_seed))
+seed = args.seed if args.seed is not None else config['world']['seed']
+if replay is not None:
+    seed = replay.seed
+if seed is not None and save_file.seed is not None and seed != save_file.seed:
+    console.warn('Saved world {0} has seed {1}, starting a new world with seed {2}'.format(save_file.path, save_file.seed, seed))
+    save_file.close()
+    save_file = SaveFile(config['world']['save']['file'])
+if seed is None:
+    seed = save_file.seed if save_file.seed is not None else uuid.uuid1().int >> 64
+world_generator = WorldGenerator.from_config(seed, config)
 console.info('Using {0} as the seed'.format(seed))
 
-# Generate world
-for z in range(world_depth):
-    zrow = []
-    for y in range(world_height):
-        row = []
-        for x in range(world_width):
-            v = int(gen.noise3d(
-                x=x / (config['world']['generator']['freq'] * config['world']['generator']['octaves']),
-                y=y / (config['world']['generator']['freq'] * config['world']['generator']['octaves']),
-                z=z / (config['world']['generator']['freq'] * config['world']['generator']['octaves'])) * 127.0 + 128.0)
-            row.append(v)
-        zrow.append(row)
-    world.append(zrow)
-console.info('Created world')
-
-# Generate tile data
-for z in range(world_depth):
-    zrow = []
-    for y in range(world_height):
-        row = []
-        for x in range(world_width):
-            v = world[z][y][x]
-            f = False
-            for t in config['terrain']:
-                if t['min'] <= abs(v) <= t['max']:
-                    if t['minz'] <= z <= t['maxz']:
-                        f = True
-                        img = default_tileset.get_image(t['x'], t['y'])
-                        row.append(Tile(name=t['name'], x=x, y=y, z=z, tangible=t['tangible'], image=img))
-            if not f:
-                console.warn('Could not find texture for tile at ({0}, {1}, {2})'.format(x, y, z))
-        zrow.append(row)
-    worldTiles.append(zrow)
-
-# Spawn mobs
-for z in range(world_depth):
-    for y in range(world_height):
-        for x in range(world_width):
-            for mob in config['mobs']:
-                if worldTiles[z][y][x].name in mob['spawn']:
-                    if random.randint(0, 100 - mob['spawn'][worldTiles[z][y][x].name]) == 1:
-                        worldEntities.append(entity_classes[mob['type']](name=mob['name'], x=x, y=y, z=z, health=mob['health'], tangible=mob['tangible'], image=default_tileset.get_image(mob['tilex'], mob['tiley'])))
-console.info('Spawned mobs')
-
-for z in range(world_depth):
-    for y in range(world_height):
-        for x in range(world_width):
-            for tile_structure in config['tile_structures']:
-                if tile_structure['random']['type'] == 'randint':
-                    if random.randint(1, tile_structure['random']['range'] - tile_structure['random']['chance']) == 1:
-                        if worldTiles[z][y][x].name in tile_structure['allowed_tiles']:
-                            tile_structure_class = tile_structure_classes[tile_structure['name']]
-                            tile_structure_object = tile_structure_class(
-                                name=tile_structure['tile']['name'],
-                                x=x,
-                                y=y,
-                                z=z,
-                                tangible=tile_structure['tile']['tangible'],
-                                image=ss.get_image(tile_structure['tile']['image']['x'],
-                                                   tile_structure['tile']['image']['y']
-                                ),
-                            )
-                            tile_structure_object.setup()
-                            worldTiles[z][y][x] = tile_structure_object
+# Setup AI random numbers
+ai_random = random.Random(seed)
+batch_random = np.random.default_rng(seed)
+
+# Create world store
+worldTiles = WorldStore(world_width, world_height, world_depth, config['world']['streaming']['chunk_size'])
+terrain_ids = [worldTiles.add_tile_type(t['name'], t['tangible'], default_tileset.get_image(t['x'], t['y'])) for t in config['terrain']]
+for t in config['tile_structures']:
+    worldTiles.add_tile_type(t['tile']['name'], t['tile']['tangible'], default_tileset.get_image(t['tile']['image']['x'], t['tile']['image']['y']))
+if save_file.file is not None:
+    save_file.use_tile_types(worldTiles.tile_type_ids)
+
+# Open world cache
+world_cache = None
+cache_file = None
+uncached_chunks = {}
+if not args.no_cache:
+    world_cache = WorldCache(config['world']['cache']['dir'], config['world']['cache']['max_size'])
+    cache_file = world_cache.open(get_generation_key(seed, config))
+    if cache_file.file is not None:
+        cache_file.use_tile_types(worldTiles.tile_type_ids)
+        console.info('Using cached world {0} ({1} chunks)'.format(cache_file.path, len(cache_file.chunks)))
+
+# Mobs and tile structures by name
+mobs_by_name = dict((mob['name'], mob) for mob in config['mobs'])
+tile_structures_by_name = dict((t['tile']['name'], t) for t in config['tile_structures'])
+tile_structure_images = dict((t['tile']['name'], default_tileset.get_image(t['tile']['image']['x'], t['tile']['image']['y'])) for t in config['tile_structures'])
+
+# Compile terrain rules
+terrain_table = TerrainTable(config['terrain'], world_depth, terrain_ids)
+for problem in terrain_table.get_problems():
+    console.warn(problem)
+
+# Compile mob spawn rules
+spawn_table = SpawnTable(seed, config['mobs'], worldTiles.tile_type_ids)
+
+# Create flow field, mobs that chase or flee the player share it
+flow_field = FlowField(worldTiles, config['world']['simulation']['flow_field_radius'])
+
+# Create field of view, the renderer only draws what the player sees on the layers it applies to
+field_of_view = FieldOfView(worldTiles, config['world']['visibility']['radius'], config['world']['visibility']['layers'])
+field_of_view.explored.update(save_file.explored)
+
+# Compile tile structure placement rules
+structure_table = StructureTable(config['tile_structures'], worldTiles.tile_type_ids)
+
+# Load radius, the renderer never loads chunks so it covers the screen when the camera is zoomed out the most
+load_radius = max(
+    config['world']['streaming']['load_radius'],
+    -(-screen_width // (2 * max(int(round(default_tileset.tile_width * zoom_levels[0])), 1))),
+    -(-screen_height // (2 * max(int(round(default_tileset.tile_height * zoom_levels[0])), 1)))
+)
+if load_radius > config['world']['streaming']['load_radius']:
+    console.info('Load radius raised to {0} to cover the screen at zoom {1}'.format(load_radius, zoom_levels[0]))
+
+# Create chunk manager, chunks are generated, populated and spawn their mobs when they are first needed
+chunk_manager = ChunkManager(
+    worldTiles,
+    world_generator,
+    terrain_table,
+    load_radius,
+    ChunkManager.get_max_chunks(worldTiles, config['world']['streaming']['memory_budget']),
+    spawn_table=spawn_table,
+    workers=config['world']['streaming']['workers'],
+    save_file=save_file,
+    cache_file=cache_file,
+    populate=populate_chunk,
+    restore=restore_chunk,
+    on_load=load_chunk,
+    on_unload=unload_chunk,
+    spill_file=SaveFile(os.path.join(config['world']['cache']['dir'], '{0}.spill'.format(os.getpid()))),
+    kept_budget=config['world']['streaming']['kept_budget'],
+    record_structure=get_structure_record
+)
+console.info('Created chunk manager ({0} chunks)'.format(chunk_manager.max_chunks))
+startup_profile.phase('world setup')
+
+# Saved entities are put back when their chunk is loaded
+for record in save_file.entities:
+    key = (record[1] // worldTiles.chunk_size, record[2] // worldTiles.chunk_size)
+    chunk_manager.kept.setdefault(key, {'tiles': None, 'structures': [], 'data': []})['data'].append(record)
+
 # Generate start position
-px = random.randint(0, world_width-1)
-py = random.randint(0, world_height-1)
-while worldTiles[world_depth - 1][py][px].tangible:
-    px = random.randint(0, world_width-1)
-    py = random.randint(0, world_height-1)
+if save_file.player is not None:
+    px, py, pz = save_file.player
+else:
+    spawn_random = random.Random('{0}:spawn'.format(seed))
+    px = spawn_random.randint(0, world_width-1)
+    py = spawn_random.randint(0, world_height-1)
+    pz = world_depth - 1
+    while worldTiles.is_tangible(px, py, pz):
+        px = spawn_random.randint(0, world_width-1)
+        py = spawn_random.randint(0, world_height-1)
 
 console.info('Generated player spawn')
 
@@ -565,7 +1025,7 @@ console.info('Generated player spawn')
 player = Player(
     x=px,
     y=py,
-    z=world_depth - 1,
+    z=pz,
     image=ss.get_image(config['player']['image']['x'], config['player']['image']['y']),
     exp=0,
     selected_item=None,
@@ -584,6 +1044,23 @@ player = Player(
 )
 console.info('Created player')
 
+# Load the world around the player
+chunk_manager.update(player.x, player.y)
+console.info('Loaded world ({chunks} chunks, {memory} bytes)'.format(**chunk_manager.get_stats()))
+cache_generated_chunks()
+startup_profile.phase('world generation')
+startup_profile.move(chunk_manager.populate_time, 'world generation', 'structures')
+startup_profile.move(chunk_manager.load_time, 'world generation', 'mobs')
+
+# Create help browser, its helper process is started with the first page unless it starts with the game
+help_offline = config['help']['offline']
+if help_offline and not os.path.isdir(config['help']['docs_dir']):
+    console.warn('Help docs not found in {0}, help pages are loaded from the website'.format(config['help']['docs_dir']))
+    help_offline = False
+help_browser = HelpBrowser(offline=help_offline, docs_dir=config['help']['docs_dir'])
+if config['help']['start_on_launch']:
+    help_browser.start()
+
 # Create menus
 menus.append(
     Menu(
@@ -617,115 +1094,175 @@ for item in items:
 item_icon = Item.icon
 console.info('Loaded icons for items')
 
-# FIX: Stairwell Bug
-for y in worldTiles[world_depth - 1]:
-    for x in y:
-        if x.name == 'stairwell':
-            x.stairwell_direction = 0
+for name, tileset in tilesets.items():
+    console.info('Tileset {0}: {images} images, {hits} hits, {misses} misses, {memory} bytes'.format(name, **tileset.get_stats()))
+
+# Create scheduler
+scheduler = SimulationScheduler(
+    config['world']['simulation']['radius'],
+    config['world']['simulation']['catch_up_interval'],
+    batch_step=do_batch_turn if config['world']['simulation']['batch_ai'] else None
+)
+
+# Create renderer
+renderer = Renderer(screen, worldTiles, default_tileset.tile_width, default_tileset.tile_height, chunk_size=config['screen']['chunk_size'], max_chunks=config['screen']['chunk_cache_size'])
+renderer.fov = field_of_view
+renderer.set_scale(camera.sx, camera.sy)
+console.info('Created renderer')
+
+# Create minimap, its overviews are drawn from the tiles of loaded chunks and patched when tiles change
+minimap = Minimap(
+    worldTiles,
+    config['screen']['minimap']['size'],
+    dict((t['name'], tuple(t['colour'])) for t in config['terrain'] if 'colour' in t),
+    field_of_view,
+    player_colour=tuple(config['screen']['minimap']['player_colour']),
+    entity_colour=tuple(config['screen']['minimap']['entity_colour']),
+    border_colour=tuple(config['screen']['minimap']['border_colour'])
+)
+minimap_rect = pygame.Rect(screen_width - config['screen']['minimap']['size'] - 8, 8, config['screen']['minimap']['size'], config['screen']['minimap']['size'])
+minimap_shown = config['screen']['minimap']['shown']
+startup_profile.phase('game setup')
+
+# Create frame clock
+frame_clock = FrameClock(0 if replay else config['screen']['fps'], config['screen']['tick_rate'], config['screen']['idle_timeout'])
+
+# Create frame profile and performance HUD, nothing is measured until the HUD is shown
+frame_profile = FrameProfile(config['screen']['perf_hud']['window'])
+perf_hud = PerformanceHud(frame_profile, 0, infoTextObject.get_rect().bottom)
+turn_queue = []
+target_entity_indicator = None
+needs_redraw = True
+
+# Record the keys that become turns
+recorder = InputRecorder(args.record, seed, get_config_hash(config), config['game']['version']) if args.record else None
 
 # Main loop
 while True:
     try:
-        # Update info text
-        infoTextObject.set_text('{0} ({1}, {2}, {3}) {4}'.format(config['game']['version'], player.x, player.y, player.z, worldTiles[player.z][player.y][player.x].name))
-
-        # Clear screen
-        screen.fill((0, 0, 0))
-
-        # Draw world
-        worldSurface = pygame.Surface((world_width*32, world_height*32))
-        for y in range(player.y - int(screen_height / 32), player.y + int(screen_height / 32) if world_height - player.y > int(screen_height / 32) else world_height):
-            for x in range(player.x - int(screen_width / 32), player.x + int(screen_width / 32) if world_width - player.x > int(screen_width / 32) else world_width):
-                v = worldTiles[player.z][y][x]
-                worldSurface.blit(v.image, [v.x * 32, v.y * 32])
-
-        for v in worldEntities:
-            if v.health <= 0:
-                worldEntities.remove(v)
-            else:
-                if player.z == v.z:
-                    worldSurface.blit(v.image, [v.x * 32, v.y * 32])
-
-        tmpos = [screen_width/2+player.x*-32, screen_height/2+player.y*-32]
-        screen.blit(worldSurface, tmpos)
-        
-        # Find entity in front of player
-        target_entity = None
-        target_entity_indicator = None
-        for mob in worldEntities:
-            if mob.z == player.z and mob.y == player.y - 1 and mob.x == player.x:
-                target_entity = mob
-                target_entity_indicator = EntityInfoIndicator(target_entity)
-
-        # Handle events
-        for event in pygame.event.get():
+        # Handle events, sleep until there is one when there is nothing to do
+        frame_start = time.perf_counter()
+        if replay is not None:
+            events = replay.get_events() if not turn_queue else []
+        else:
+            events = frame_clock.get_events(idle=not needs_redraw and not turn_queue)
+        frame_profile.begin_frame()
+        for event in events:
             if event.type == pygame.QUIT:  # event is quit
-                exit()
+                quit_game()
+            elif event.type == pygame.KEYDOWN and event.key == pygame.K_F3:
+                # Toggle the performance HUD, it is not a turn
+                frame_profile.toggle()
+                renderer.timed = frame_profile.enabled
+                perf_hud.last_update = None
+                needs_redraw = True
+            elif event.type == pygame.KEYDOWN and event.key == pygame.K_F4:
+                frame_profile.capture(config['screen']['perf_hud']['profile_frames'], os.path.join(config['screen']['perf_hud']['profile_dir'], 'frames-{0}.prof'.format(time.strftime('%Y%m%d-%H%M%S'))))
+                console.info('Profiling the next {0} frames'.format(config['screen']['perf_hud']['profile_frames']))
+            elif event.type == pygame.KEYDOWN and event.key == pygame.K_TAB:
+                # Show or hide the minimap, it is not a turn
+                minimap_shown = not minimap_shown
+                needs_redraw = True
+            elif event.type == pygame.KEYDOWN and event.key in ZOOM_KEYS:
+                # Zoom the camera in or out, it is not a turn
+                if camera.zoom(zoom_levels, ZOOM_KEYS[event.key]):
+                    renderer.set_scale(camera.sx, camera.sy)
+                    needs_redraw = True
             elif event.type == pygame.KEYDOWN:
-                if menu_open:
-                    if event.key == menu_open.toggle_key:
-                        menu_open.close()
-                    else:
-                        menu_open.handle_key(event.key)
-                else:
-                    if event.key == pygame.K_ESCAPE:  # event is escape key
-                        quit_game()
-                    elif event.key == pygame.K_UP:
-                        tile = worldTiles[int(player.z)][int(player.y) - 1][int(player.x)]
-                        if not tile.tangible and not check_entity_collision(player.x, player.y - 1, player.z):
-                            player.y -= 1
-                    elif event.key == pygame.K_DOWN:
-                        tile = worldTiles[int(player.z)][int(player.y) + 1][int(player.x)]
-                        if not tile.tangible and not check_entity_collision(player.x, player.y + 1, player.z):
-                            player.y += 1
-                    elif event.key == pygame.K_LEFT:
-                        tile = worldTiles[int(player.z)][int(player.y)][int(player.x) - 1]
-                        if not tile.tangible and not check_entity_collision(player.x - 1, player.y, player.z):
-                            player.x -= 1
-                    elif event.key == pygame.K_RIGHT:
-                        tile = worldTiles[int(player.z)][int(player.y)][int(player.x) + 1]
-                        if not tile.tangible and not check_entity_collision(player.x + 1, player.y, player.z):
-                            player.x += 1
-                    elif event.key == pygame.K_a:
-                        if player.selected_item and target_entity:
-                            player.selected_item.on_attack(self=player.selected_item, target=target_entity)
-                    elif event.key == pygame.K_l:
-                        player.z -= 1
-                    elif event.key == pygame.K_p:
-                        player.z += 1
-                    if worldTiles[player.z][player.y][player.x].name == 'stairwell':
-                        if worldTiles[player.z][player.y][player.x].stairwell_direction == 1:
-                            # BUG: Crashes when going to over max, can't solve in generator
-                            player.z += 1
-                        elif worldTiles[player.z][player.y][player.x].stairwell_direction == 0:
-                            player.z -= 1
-                    for menu in menus:
-                        if event.key == menu.toggle_key:
-                            menu.toggle()
-
-                    if menu_open == None:
-                        for v in worldEntities:
-                            v.do_turn()
-
-        if player.z >= world_depth:
-            player.z -= 1
-            
-        # Draw objects
-        if target_entity_indicator:
-            target_entity_indicator.draw()
-
-        infoTextObject.draw(screen)
-        player.draw()
-
-        if player.selected_item:
-            screen.blit(player.selected_item.icon, [0, screen_height - 32])
-
-        # Draw menus
-        for menu in menus:
-            menu.draw(screen)
-
-        # Flip the display
-        pygame.display.flip()
+                turn_queue.append(event.key)
+            elif event.type in (pygame.VIDEOEXPOSE, pygame.ACTIVEEVENT):
+                renderer.invalidate()
+                needs_redraw = True
+        frame_profile.phase('events')
+
+        # Run the simulation, one key per tick, replays run every key right away
+        for tick in range(len(turn_queue) if replay is not None else frame_clock.get_ticks()):
+            if not turn_queue:
+                break
+            key = turn_queue.pop(0)
+            if recorder is not None:
+                recorder.record(key)
+            turn_start = time.perf_counter()
+            handle_key(key)
+            needs_redraw = True
+            if replay is not None:
+                replay.add_turn(time.perf_counter() - turn_start)
+        frame_profile.phase('turns')
+
+        if frame_profile.enabled and perf_hud.update():
+            needs_redraw = True
+
+        if needs_redraw:
+            # Update info text
+            infoTextObject.set_text('{0} ({1}, {2}, {3}) {4}'.format(config['game']['version'], player.x, player.y, player.z, worldTiles.get_name(player.x, player.y, player.z)))
+
+            # Find what the player sees and move the minimap along
+            field_of_view.update(player.x, player.y, player.z)
+            if minimap_shown:
+                minimap.update(player.x, player.y)
+
+            # Draw objects
+            overlays = []
+            target_entity = get_target_entity()
+            if target_entity:
+                if target_entity_indicator is None or target_entity_indicator.entity is not target_entity:
+                    target_entity_indicator = EntityInfoIndicator(target_entity)
+                overlays.append(Overlay('indicator', (id(target_entity), target_entity.name, target_entity.health), target_entity_indicator.get_rect(), target_entity_indicator.draw))
+
+            overlays.append(Overlay('info_text', infoTextObject.text, infoTextObject.get_rect(), lambda: infoTextObject.draw(screen)))
+            overlays.append(Overlay('player', (player.image, renderer.scale), player.get_rect(), player.draw))
+
+            if minimap_shown:
+                overlays.append(Overlay('minimap', (player.x, player.y, player.z, scheduler.turn, minimap.version, field_of_view.version), minimap_rect.inflate(2, 2),
+                                        lambda: minimap.draw(screen, minimap_rect, player.x, player.y, player.z, entity_index.query_rect(*minimap.get_area(player.x, player.y, player.z)))))
+
+            if player.selected_item:
+                overlays.append(Overlay('selected_item', player.selected_item, (0, screen_height - 32, 32, 32), lambda: screen.blit(player.selected_item.icon, [0, screen_height - 32])))
+
+            # Draw menus
+            for menu in menus:
+                if menu.isOpen:
+                    overlays.append(Overlay('menu_' + menu.name, menu.selectedItem, menu.get_rect(), lambda menu=menu: menu.draw(screen)))
+
+            if frame_profile.enabled:
+                overlays.append(Overlay('perf_hud', perf_hud.version, perf_hud.get_rect(), perf_hud.draw))
+            frame_profile.phase('prepare')
+
+            # Draw world and update the parts of the display that changed
+            camera_position = (player.x, player.y, player.z)
+            tiles_rendered = renderer.chunk_cache.tiles_blitted
+            cache_misses = renderer.chunk_cache.misses + renderer.images.misses + text_cache.misses
+            renderer.draw_frame(worldTiles, camera_position, entity_index.query_rect(*renderer.get_visible_area(camera_position)), overlays)
+            needs_redraw = False
+
+            # Split the time of the renderer into the parts it timed
+            frame_profile.phase('world draw')
+            if frame_profile.enabled:
+                times = renderer.times
+                frame_profile.move(times['entities'], 'world draw', 'entity draw')
+                frame_profile.move(times.get('indicator', 0.0), 'world draw', 'indicator')
+                frame_profile.move(sum(t for name, t in times.items() if name.startswith('menu_')), 'world draw', 'menus')
+                frame_profile.move(sum(t for name, t in times.items() if name in ('info_text', 'player', 'minimap', 'selected_item', 'perf_hud')), 'world draw', 'overlays')
+                frame_profile.move(times['flip'], 'world draw', 'flip')
+                frame_profile.count('entities', len(worldEntities))
+                frame_profile.count('blits', renderer.chunks_blitted + renderer.sprites_blitted)
+                frame_profile.count('chunk tiles rendered', renderer.chunk_cache.tiles_blitted - tiles_rendered)
+                frame_profile.count('cache misses', renderer.chunk_cache.misses + renderer.images.misses + text_cache.misses - cache_misses)
+
+            # Print the startup profile after the first frame
+            if startup_profile is not None:
+                startup_profile.phase('first frame')
+                if args.profile_startup:
+                    for line in startup_profile.get_report():
+                        console.info('Startup: ' + line)
+                startup_profile = None
+
+        capture = frame_profile.end_frame()
+        if capture:
+            console.info('Saved frame profile to {0}'.format(capture))
+        if replay is not None:
+            replay.add_frame(time.perf_counter() - frame_start)
+        frame_clock.end_frame()
     except Exception as ex:
         s = traceback.format_exc()
         for i in s.split('\n'):
@@ -733,5 +1270,13 @@ while True:
             t.draw(surface=screen, x=0, y=traceback.format_exc().split('\n').index(i) * t.text_object.get_size()[1])
             console.error(i)
         pygame.display.flip()
+
+        # Nobody can close the window of a replay or a game without a display, they stop with an error
+        if replay is not None or os.environ.get('SDL_VIDEODRIVER') == 'dummy':
+            console.error('Stopping after the error, there is no window to close')
+            chunk_manager.close()
+            help_browser.close()
+            exit(1)
         while True:
-            continue
+            if pygame.event.wait().type == pygame.QUIT:
+                quit_game()
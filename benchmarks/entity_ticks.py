@@ -0,0 +1,86 @@
+#! /usr/bin/env python3
+
+# Benchmark for entity turns, compares giving every pig a turn one by one with the batched EntityStore step
+
+# Imports
+import os
+import random
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from entityindex import EntityIndex
+from entitystore import AI_ANIMAL, EntityStore, get_object_step
+from pathfinding import WANDER
+from worldstore import WorldStore
+
+# World size and number of pigs
+size = 2048
+pigs = 100000
+turns = 5
+
+
+# Pig class, takes its turns with the AI of AnimalEntity in __main__.py
+class Pig:
+    def __init__(self, x, y, z):
+        self.x = x
+        self.y = y
+        self.z = z
+        self.tangible = True
+
+    def do_turn(self, world, index, rng, player):
+        step = get_object_step(AI_ANIMAL, WANDER, self.x, self.y, self.z, world, player, rng)
+        if step is not None:
+            index.move(self, self.x + step[0], self.y + step[1], self.z)
+
+
+# Create world function, a layer of grass with some walls
+def create_world():
+    world = WorldStore(size, size, 1)
+    grass = world.add_tile_type('grass', False, None)
+    wall = world.add_tile_type('wall', True, None)
+    rng = np.random.default_rng(0)
+    world.set_layer(0, np.where(rng.random((size, size)) < 0.1, wall, grass).astype(np.uint8))
+    return world
+
+
+# Benchmark objects function
+def benchmark_objects(world, xs, ys):
+    index = EntityIndex()
+    entities = [Pig(x, y, 0) for x, y in zip(xs.tolist(), ys.tolist())]
+    for entity in entities:
+        index.add(entity)
+
+    rng = random.Random(0)
+    start = time.perf_counter()
+    for turn in range(turns):
+        for entity in entities:
+            entity.do_turn(world, index, rng, (0, 0, 0))
+    return (time.perf_counter() - start) / turns
+
+
+# Benchmark batch function
+def benchmark_batch(world, xs, ys):
+    store = EntityStore()
+    indices = store.add_many(xs, ys, np.zeros(len(xs)), 10, True, AI_ANIMAL)
+
+    rng = np.random.default_rng(0)
+    start = time.perf_counter()
+    for turn in range(turns):
+        store.step(indices, world, (0, 0, 0), rng)
+    return (time.perf_counter() - start) / turns
+
+
+if __name__ == '__main__':
+    world = create_world()
+    rng = np.random.default_rng(1)
+    xs = rng.integers(1, size, pigs)
+    ys = rng.integers(1, size, pigs)
+
+    objects = benchmark_objects(world, xs, ys)
+    batch = benchmark_batch(world, xs, ys)
+    print('{0} pigs, objects: {1:.4f}s/turn'.format(pigs, objects))
+    print('{0} pigs, batch: {1:.4f}s/turn ({2:.1f}x)'.format(pigs, batch, objects / batch))
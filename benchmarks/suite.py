@@ -0,0 +1,456 @@
+#! /usr/bin/env python3
+
+# Benchmark suite, times world generation, rendering, entity turns and text with fixed seeds and no real display.
+# Writes the results as JSON with --output and flags regressions against an older result with --baseline.
+
+# Imports
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import time
+
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+
+import numpy as np
+import pygame
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from chunkmanager import generate_chunk
+from entity_ticks import Pig, create_world
+from entityindex import EntityIndex
+from entitystore import AI_ANIMAL, EntityStore
+from pathfinding import CHASE, FlowField
+from renderer import Renderer, TextCache
+from minimap import Minimap
+from visibility import FieldOfView
+from worldgen import SpawnTable, StructureTable, TerrainTable, WorldGenerator
+from worldstore import WorldStore
+from tilestructures import place_tile_structures
+
+# Seed of every benchmark world
+SEED = 0
+
+# Chunks generated per run of the world generation benchmarks
+CHUNKS = [(cx, cy) for cy in range(4) for cx in range(4)]
+
+# World sizes of the frame benchmarks, on a 768x768 screen
+MAP_SIZES = [256, 1024, 4096]
+
+# Camera scales of the zoomed frame benchmarks, on a 768x768 screen
+ZOOM_LEVELS = [0.25, 0.5, 2]
+
+# Mob counts of the entity benchmarks, the object ones are left out above 10k because they take too long
+MOB_COUNTS = [1000, 10000, 100000]
+
+# Benchmarks, filled in by the benchmark decorator
+benchmarks = {}
+
+
+# Benchmark decorator
+def benchmark(name):
+    ''' Add a benchmark. The function sets it up and returns what is timed, a function that takes no arguments. '''
+    def add(setup):
+        benchmarks[name] = setup
+        return setup
+    return add
+
+
+# Read config function
+def read_config():
+    config = {}
+    for name in ('world', 'terrain', 'mobs', 'tile_structures', 'fonts', 'menu'):
+        with open(os.path.join(ROOT, 'config', name + '.json')) as f:
+            config.update(json.load(f))
+    return config
+
+
+# Generation class
+class Generation:
+    ''' Everything the world generation benchmarks need, made from the game config '''
+
+    def __init__(self, config):
+        world = config['world']
+        self.config = config
+        self.world = WorldStore(world['width'], world['height'], world['depth'], world['streaming']['chunk_size'])
+        terrain_ids = [self.world.add_tile_type(t['name'], t['tangible'], None) for t in config['terrain']]
+        for t in config['tile_structures']:
+            self.world.add_tile_type(t['tile']['name'], t['tile']['tangible'], None)
+        self.generator = WorldGenerator.from_config(SEED, config)
+        self.terrain_table = TerrainTable(config['terrain'], world['depth'], terrain_ids)
+        self.spawn_table = SpawnTable(SEED, config['mobs'], self.world.tile_type_ids)
+        self.structure_table = StructureTable(config['tile_structures'], self.world.tile_type_ids)
+
+    def get_heights(self, cx, cy):
+        cs = self.world.chunk_size
+        return [self.generator.generate_layer(z, cx * cs, cy * cs, cs, cs) for z in range(self.world.depth)]
+
+    def get_tiles(self, cx, cy):
+        return np.stack([self.terrain_table.classify(heights, z) for z, heights in enumerate(self.get_heights(cx, cy))])
+
+
+@benchmark('generation/noise')
+def noise(config):
+    generation = Generation(config)
+    return lambda: [generation.get_heights(cx, cy) for cx, cy in CHUNKS]
+
+
+@benchmark('generation/classify')
+def classify(config):
+    generation = Generation(config)
+    heights = [generation.get_heights(cx, cy) for cx, cy in CHUNKS]
+    classify = generation.terrain_table.classify
+    return lambda: [[classify(layer, z) for z, layer in enumerate(chunk)] for chunk in heights]
+
+
+@benchmark('generation/spawn')
+def spawn(config):
+    generation = Generation(config)
+    cs = generation.world.chunk_size
+    tiles = [(cx, cy, generation.get_tiles(cx, cy)) for cx, cy in CHUNKS]
+    return lambda: [generation.spawn_table.spawn(t, cx, cy, cx * cs, cy * cs) for cx, cy, t in tiles]
+
+
+@benchmark('generation/structures')
+def structures(config):
+    generation = Generation(config)
+    world = generation.world
+    tiles = [(cx, cy, generation.get_tiles(cx, cy)) for cx, cy in CHUNKS]
+
+    def run():
+        for cx, cy, t in tiles:
+            world.load_chunk(cx, cy, t)
+            place_tile_structures(world, SEED, generation.structure_table, config['tile_structures'], {}, cx, cy)
+        for cx, cy, t in tiles:
+            world.unload_chunk(cx, cy)
+    return run
+
+
+@benchmark('generation/chunk')
+def chunk(config):
+    generation = Generation(config)
+    world = generation.world
+    tiles = np.empty((world.depth, world.chunk_size, world.chunk_size), dtype=np.uint8)
+    return lambda: [generate_chunk(generation.generator, generation.terrain_table, generation.spawn_table, world.chunk_size, cx, cy, tiles) for cx, cy in CHUNKS]
+
+
+# Create frame world function
+def create_frame_world(size):
+    ''' A size x size world of 8 random coloured tiles on a 768x768 screen '''
+    screen = pygame.display.set_mode((768, 768))
+    world = WorldStore(size, size, 1, 32)
+    rng = np.random.default_rng(SEED)
+    for i in range(8):
+        image = pygame.Surface((32, 32)).convert()
+        image.fill(tuple(int(c) for c in rng.integers(0, 256, 3)))
+        world.add_tile_type(str(i), False, image)
+    world.set_layer(0, rng.integers(0, 8, (size, size)).astype(np.uint8))
+    return screen, world
+
+
+# Frame benchmark function
+def frame(size, scale=1):
+    ''' Walk the camera back and forth in the middle of a random size x size world zoomed to scale,
+        every frame is a full redraw from the chunk cache '''
+    def setup(config):
+        screen, world = create_frame_world(size)
+        renderer = Renderer(screen, world, 32, 32)
+        renderer.set_scale(scale, scale)
+        path = [(size // 2 + dx, size // 2, 0) for dx in list(range(8)) + list(range(8, 0, -1))]
+        for camera in path:
+            renderer.draw_frame(world, camera, [], [])
+
+        def run():
+            for camera in path:
+                renderer.draw_frame(world, camera, [], [])
+        return run
+    return setup
+
+
+for size in MAP_SIZES:
+    benchmark('frame/map/{0}'.format(size))(frame(size))
+for scale in ZOOM_LEVELS:
+    benchmark('frame/zoom/{0}'.format(scale))(frame(256, scale))
+
+
+# Frame mobs benchmark function
+def frame_mobs(full):
+    ''' 16 frames with the camera standing still and 20 of 200 mobs on screen moving every frame,
+        only the tiles under the mobs that moved are redrawn unless full is set '''
+    def setup(config):
+        screen, world = create_frame_world(256)
+        renderer = Renderer(screen, world, 32, 32)
+        image = pygame.Surface((32, 32)).convert()
+        image.fill((255, 192, 203))
+        rng = np.random.default_rng(SEED)
+        entities = [Pig(int(x), int(y), 0) for x, y in rng.integers(117, 139, (200, 2))]
+        for entity in entities:
+            entity.image = image
+        moving = entities[:20]
+        camera = (128, 128, 0)
+        renderer.draw_frame(world, camera, entities, [])
+
+        def run():
+            for i in range(16):
+                d = 1 if i % 2 else -1
+                for entity in moving:
+                    entity.x += d
+                if full:
+                    renderer.invalidate()
+                renderer.draw_frame(world, camera, entities, [])
+        return run
+    return setup
+
+
+benchmark('frame/steady/768x768')(frame_mobs(False))
+benchmark('frame/mobs/768x768')(frame_mobs(True))
+
+
+@benchmark('frame/fov/768x768')
+def frame_fov(config):
+    ''' Walk the player back and forth through a random dungeon, the field of view is cast again every step '''
+    screen = pygame.display.set_mode((768, 768))
+    world = WorldStore(256, 256, 1, 32)
+    rng = np.random.default_rng(SEED)
+    for i in range(8):
+        image = pygame.Surface((32, 32)).convert()
+        image.fill(tuple(int(c) for c in rng.integers(0, 256, 3)))
+        world.add_tile_type(str(i), i == 7, image)
+    world.set_layer(0, np.where(rng.random((256, 256)) < 0.1, 7, rng.integers(0, 7, (256, 256))).astype(np.uint8))
+    renderer = Renderer(screen, world, 32, 32)
+    renderer.fov = FieldOfView(world, config['world']['visibility']['radius'], [0])
+    path = [(128 + dx, 128, 0) for dx in list(range(8)) + list(range(8, 0, -1))]
+
+    def run():
+        for camera in path:
+            renderer.fov.update(*camera)
+            renderer.draw_frame(world, camera, [], [])
+    run()
+    return run
+
+
+@benchmark('minimap/128')
+def minimap(config):
+    ''' Walk the player back and forth, changing a tile and drawing the 128 pixel minimap with 1000 markers every step '''
+    screen = pygame.display.set_mode((768, 768))
+    world = WorldStore(256, 256, 2, 32)
+    rng = np.random.default_rng(SEED)
+    for i in range(8):
+        image = pygame.Surface((32, 32)).convert()
+        image.fill(tuple(int(c) for c in rng.integers(0, 256, 3)))
+        world.add_tile_type(str(i), False, image)
+    world.set_layer(0, rng.integers(0, 8, (256, 256)).astype(np.uint8))
+    world.set_layer(1, rng.integers(0, 8, (256, 256)).astype(np.uint8))
+    minimap = Minimap(world, 128, {})
+    entities = [Pig(int(x), int(y), 0) for x, y in rng.integers(64, 192, (1000, 2))]
+    path = [(128 + dx, 128, dx % 2) for dx in list(range(8)) + list(range(8, 0, -1))]
+    rect = pygame.Rect(632, 8, 128, 128)
+
+    def run():
+        for x, y, z in path:
+            world.set_tile_type(x, y + 1, z, x % 8)
+            minimap.update(x, y)
+            minimap.draw(screen, rect, x, y, z, entities)
+    run()
+    return run
+
+
+# Entity benchmark functions
+def entity_positions(mobs):
+    rng = np.random.default_rng(1)
+    return rng.integers(1, 2048, mobs), rng.integers(1, 2048, mobs)
+
+
+def entity_objects(mobs):
+    def setup(config):
+        world = create_world()
+        index = EntityIndex()
+        entities = [Pig(x, y, 0) for x, y in zip(*(a.tolist() for a in entity_positions(mobs)))]
+        for entity in entities:
+            index.add(entity)
+        rng = random.Random(0)
+
+        def run():
+            for entity in entities:
+                entity.do_turn(world, index, rng, (0, 0, 0))
+        return run
+    return setup
+
+
+def entity_batch(mobs):
+    def setup(config):
+        world = create_world()
+        xs, ys = entity_positions(mobs)
+        store = EntityStore()
+        indices = store.add_many(xs, ys, np.zeros(mobs), 10, True, AI_ANIMAL)
+        rng = np.random.default_rng(0)
+        return lambda: store.step(indices, world, (0, 0, 0), rng)
+    return setup
+
+
+@benchmark('entities/chase/10000')
+def entity_chase(config):
+    ''' 10000 chasing mobs around a player that walks back and forth, the flow field is built again every turn '''
+    world = create_world()
+    rng = np.random.default_rng(1)
+    xs = rng.integers(1000, 1048, 10000)
+    ys = rng.integers(1000, 1048, 10000)
+    store = EntityStore()
+    indices = store.add_many(xs, ys, np.zeros(10000), 10, True, AI_ANIMAL, CHASE)
+    flow_field = FlowField(world, 24)
+    rng = np.random.default_rng(0)
+    path = [(1024 + dx, 1024, 0) for dx in list(range(4)) + list(range(4, 0, -1))]
+
+    def run():
+        for player in path:
+            flow_field.set_target(*player)
+            store.step(indices, world, player, rng, flow_field)
+    return run
+
+
+@benchmark('entities/chase-move/10000')
+def entity_chase_move(config):
+    ''' 10000 chasing mobs around a player that walks a square of 32 tiles, one tile every turn,
+        so every turn pays for a full build of the flow field '''
+    world = create_world()
+    rng = np.random.default_rng(1)
+    xs = rng.integers(1000, 1048, 10000)
+    ys = rng.integers(1000, 1048, 10000)
+    store = EntityStore()
+    indices = store.add_many(xs, ys, np.zeros(10000), 10, True, AI_ANIMAL, CHASE)
+    flow_field = FlowField(world, 24)
+    rng = np.random.default_rng(0)
+    path = [(1020 + i, 1020, 0) for i in range(8)] + [(1028, 1020 + i, 0) for i in range(8)] + \
+        [(1028 - i, 1028, 0) for i in range(8)] + [(1020, 1028 - i, 0) for i in range(8)]
+
+    def run():
+        for player in path:
+            flow_field.set_target(*player)
+            store.step(indices, world, player, rng, flow_field)
+    return run
+
+
+for mobs in MOB_COUNTS:
+    if mobs <= 10000:
+        benchmark('entities/objects/{0}'.format(mobs))(entity_objects(mobs))
+    benchmark('entities/batch/{0}'.format(mobs))(entity_batch(mobs))
+
+
+# Text benchmark functions
+def load_font(config):
+    font = next(f for f in config['fonts'] if f['default'])
+    return pygame.font.Font(os.path.join(ROOT, 'assets', 'fonts', font['file']), int(font['size']))
+
+
+def get_info_texts():
+    ''' The info text of a player walking around, most strings come back more than once '''
+    rng = random.Random(SEED)
+    x, y = 100, 100
+    texts = []
+    for i in range(200):
+        x += rng.randint(-1, 1)
+        y += rng.randint(-1, 1)
+        texts.append('0.0.4 ({0}, {1}, 7) grass'.format(x, y))
+    return texts
+
+
+@benchmark('text/render')
+def text_render(config):
+    font = load_font(config)
+    texts = get_info_texts()
+    return lambda: [font.render(text, 0, (255, 255, 255)) for text in texts]
+
+
+@benchmark('text/cached')
+def text_cached(config):
+    font = load_font(config)
+    texts = get_info_texts()
+    text_cache = TextCache(256)
+    return lambda: [text_cache.render(font, text, (255, 255, 255)) for text in texts]
+
+
+@benchmark('text/menu')
+def text_menu(config):
+    ''' Render a 20 item menu for every selected item, like Menu.render in __main__.py '''
+    pygame.display.set_mode((64, 64))
+    font = load_font(config)
+    colors = config['menu']['colors']
+    items = ['Item {0}'.format(i) for i in range(20)]
+    surface = pygame.Surface((200, font.get_height() * (len(items) + 1)))
+    text_cache = TextCache(256)
+
+    def run():
+        for selected in range(len(items)):
+            surface.fill(colors['background'])
+            surface.blit(text_cache.render(font, 'Inventory', colors['title']), (0, 0))
+            for index, text in enumerate(items):
+                surface.blit(text_cache.render(font, text, colors['selected'] if index == selected else colors['default']), (0, font.get_height() * (index + 1)))
+    return run
+
+
+# Run function
+def run(setup, config, repeats):
+    ''' Time a benchmark, returns the fastest and median seconds of repeats runs after one warm up run '''
+    function = setup(config)
+    function()
+    times = []
+    for i in range(repeats):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return {'min': min(times), 'median': statistics.median(times), 'repeats': repeats}
+
+
+# Compare function
+def compare(results, baseline, threshold):
+    ''' Benchmarks whose fastest time is more than threshold slower than in baseline, as (name, old, new) '''
+    regressions = []
+    for name, result in results.items():
+        old = baseline.get(name)
+        if old is not None and result['min'] > old['min'] * (1 + threshold):
+            regressions.append((name, old['min'], result['min']))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='ExploreGame benchmark suite')
+    parser.add_argument('names', nargs='*', help='only run the benchmarks whose name starts with one of these')
+    parser.add_argument('--repeats', type=int, default=5, help='timed runs of every benchmark')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--baseline', help='compare with the results in this JSON file, exits with 1 when something got slower')
+    parser.add_argument('--threshold', type=float, default=0.2, help='how much slower than the baseline is a regression')
+    args = parser.parse_args()
+
+    pygame.display.init()
+    pygame.font.init()
+    config = read_config()
+    results = {}
+    for name, setup in benchmarks.items():
+        if args.names and not any(name.startswith(n) for n in args.names):
+            continue
+        results[name] = run(setup, config, args.repeats)
+        print('{0:24} {1:10.3f} ms  (median {2:.3f} ms)'.format(name, results[name]['min'] * 1000, results[name]['median'] * 1000))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'python': platform.python_version(),
+                'numpy': np.__version__,
+                'pygame': pygame.version.ver,
+                'results': results
+            }, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f)['results'], args.threshold)
+        for name, old, new in regressions:
+            print('Regression: {0} {1:.3f} ms -> {2:.3f} ms ({3:+.0%})'.format(name, old * 1000, new * 1000, new / old - 1))
+        if regressions:
+            sys.exit(1)
+        print('No regressions')
@@ -0,0 +1,34 @@
+#! /usr/bin/env python3
+
+# Benchmark for the world generator, prints how many z-layers per second it can generate
+
+# Imports
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from worldgen import WorldGenerator
+
+# Sizes to benchmark and how many layers to generate for each
+sizes = [
+    (128, 16),
+    (512, 4),
+    (2048, 1)
+]
+
+
+# Benchmark function
+def benchmark(size, layers, octaves=1):
+    generator = WorldGenerator(seed=0, width=size, height=size, depth=layers, freq=16, octaves=octaves, z_multiplier=16)
+    start = time.perf_counter()
+    for z in range(layers):
+        generator.generate_layer(z)
+    return layers / (time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+    octaves = int(sys.argv[1]) if len(sys.argv) > 1 else 1
+    for size, layers in sizes:
+        print('{0}x{0}: {1:.2f} layers/s ({2} octaves)'.format(size, benchmark(size, layers, octaves), octaves))
@@ -0,0 +1,333 @@
+# Imports
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context, shared_memory
+import os
+import sys
+import time
+import zlib
+import numpy as np
+
+# State of a generator worker process, set by init_worker
+worker = {}
+
+# Workers are forked so they do not run the game again when they start, this is only safe on Linux,
+# on macOS forking a process with a display open can crash and other systems can not fork
+FORK_WORKERS = sys.platform.startswith('linux')
+
+
+# Generate chunk function
+def generate_chunk(generator, terrain_table, spawn_table, chunk_size, cx, cy, tiles):
+    ''' Fill tiles with the tile ids of a chunk, returns the mobs it spawns or None without a spawn table '''
+    x0 = cx * chunk_size
+    y0 = cy * chunk_size
+    width = min(chunk_size, generator.width - x0)
+    height = min(chunk_size, generator.height - y0)
+    tiles[:] = 0
+    for z in range(generator.depth):
+        tiles[z, :height, :width] = terrain_table.classify(generator.generate_layer(z, x0, y0, width, height), z)
+    if spawn_table is None:
+        return None
+    return spawn_table.spawn(tiles[:, :height, :width], cx, cy, x0, y0)
+
+
+# Init worker function
+def init_worker(generator, terrain_table, spawn_table, chunk_size, memory_name, shape):
+    memory = shared_memory.SharedMemory(name=memory_name)
+    worker.update(
+        generator=generator,
+        terrain_table=terrain_table,
+        spawn_table=spawn_table,
+        chunk_size=chunk_size,
+        memory=memory,
+        staging=np.ndarray(shape, dtype=np.uint8, buffer=memory.buf)
+    )
+
+
+# Generate chunk in worker function
+def generate_chunk_in_worker(cx, cy, slot):
+    ''' Generate a chunk into a slot of the shared staging array, only the spawns are sent back '''
+    return generate_chunk(worker['generator'], worker['terrain_table'], worker['spawn_table'], worker['chunk_size'], cx, cy, worker['staging'][slot])
+
+
+# Chunk Manager class
+class ChunkManager:
+    ''' Generates the chunks of a WorldStore when they are first needed.
+        Every chunk is a column of chunk_size x chunk_size tiles on every layer,
+        so tile structures that pair up across layers, like stairwells, always
+        end up in the same chunk. Chunks are generated from the world seed alone,
+        so a chunk is the same no matter when or in what order it is generated.
+
+        Chunks within load_radius tiles of the player are kept loaded, the least
+        recently used chunks outside of it are unloaded when more than max_chunks
+        are loaded. Unloaded chunks are generated again when they are needed,
+        chunks whose tiles changed after they were generated are kept compressed.
+        When the kept tiles take more than kept_budget bytes, the oldest are written
+        to the spill file, a save file that is only used while the game runs, with
+        the records record_structure(structure) gives for their tile structures.
+
+        With more than one worker, chunks that are needed at the same time are
+        generated by a pool of processes. The workers write the tile ids into a
+        shared staging array and only send back the mobs they spawn, then the
+        tile structures are placed one chunk at a time in this process.
+
+        When there is a save file, chunks in it are read from it instead of being
+        generated and restore(cx, cy, structures) is called with the records of
+        their tile structures. Chunks that were generated or changed since the last
+        save are unsaved. The cache file is a save file of chunks as they were
+        generated, chunks in it are read from it with the mobs it has for them.
+
+        populate(cx, cy) is called after a chunk was generated to place its tile
+        structures. on_load(cx, cy, data, spawns) is called after every load with
+        what on_unload(cx, cy) returned when the chunk was last unloaded, or None,
+        and the mobs the spawn table spawned when the chunk was new. '''
+
+    def __init__(self, world, generator, terrain_table, load_radius, max_chunks, spawn_table=None, workers=1, save_file=None, cache_file=None, populate=None, restore=None, on_load=None, on_unload=None, spill_file=None, kept_budget=None, record_structure=None):
+        self.world = world
+        self.generator = generator
+        self.terrain_table = terrain_table
+        self.spawn_table = spawn_table
+        self.load_radius = load_radius
+        self.max_chunks = max_chunks
+        self.save_file = save_file
+        self.cache_file = cache_file
+        self.populate = populate
+        self.restore = restore
+        self.on_load = on_load
+        self.on_unload = on_unload
+        self.spill_file = spill_file
+        self.kept_budget = kept_budget
+        self.record_structure = record_structure
+        self.chunks = OrderedDict()
+        self.kept = {}
+        self.kept_size = 0
+        self.unsaved = set()
+        world.loader = self.load
+        world.add_listener(self.on_tile_changed)
+
+        # 0 workers means one per core, without FORK_WORKERS chunks are generated in this process
+        self.workers = (workers or os.cpu_count() or 1) if FORK_WORKERS else 1
+        self.executor = None
+        self.memory = None
+        self.staging = None
+
+        # Counters
+        self.generated = 0
+        self.opened = 0
+        self.cached = 0
+
+        # Seconds spent in populate and on_load
+        self.populate_time = 0.0
+        self.load_time = 0.0
+        self.restored = 0
+        self.unloaded = 0
+        self.spilled = 0
+
+    @classmethod
+    def get_max_chunks(cls, world, memory_budget):
+        ''' How many chunks of world fit in memory_budget bytes '''
+        return max(1, memory_budget // (world.depth * world.chunk_size * world.chunk_size))
+
+    def generate(self, cx, cy):
+        ''' Generate the tile ids of a chunk, returns them and the mobs it spawns '''
+        tiles = np.empty((self.world.depth, self.world.chunk_size, self.world.chunk_size), dtype=np.uint8)
+        spawns = generate_chunk(self.generator, self.terrain_table, self.spawn_table, self.world.chunk_size, cx, cy, tiles)
+        return tiles, spawns
+
+    def start_workers(self):
+        ''' Start the worker processes and the staging array they share with this process '''
+        shape = (self.workers * 4, self.world.depth, self.world.chunk_size, self.world.chunk_size)
+        self.memory = shared_memory.SharedMemory(create=True, size=int(np.prod(shape)))
+        self.staging = np.ndarray(shape, dtype=np.uint8, buffer=self.memory.buf)
+        self.executor = ProcessPoolExecutor(
+            self.workers,
+            mp_context=get_context('fork'),
+            initializer=init_worker,
+            initargs=(self.generator, self.terrain_table, self.spawn_table, self.world.chunk_size, self.memory.name, shape)
+        )
+
+    def generate_many(self, keys):
+        ''' Generate chunks in the worker processes, yields the key, tile ids and spawns of every chunk in order '''
+        if self.executor is None:
+            self.start_workers()
+
+        slots = len(self.staging)
+        for start in range(0, len(keys), slots):
+            batch = keys[start:start + slots]
+            futures = [self.executor.submit(generate_chunk_in_worker, cx, cy, slot) for slot, (cx, cy) in enumerate(batch)]
+            for slot, (key, future) in enumerate(zip(batch, futures)):
+                spawns = future.result()
+                yield key, self.staging[slot], spawns
+
+    def close(self):
+        ''' Stop the worker processes and remove the spill file '''
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.staging = None
+            self.memory.close()
+            self.memory.unlink()
+            self.executor = None
+        if self.spill_file is not None and self.spill_file.file is not None:
+            self.spill_file.close()
+            os.remove(self.spill_file.path)
+
+    def load(self, cx, cy, generated=None):
+        ''' Load a chunk, generating it unless its changed tiles were kept or it is in the save file.
+            generated is the tile ids and spawns of the chunk when they were already generated. '''
+        key = (cx, cy)
+        if key in self.chunks:
+            self.chunks.move_to_end(key)
+            return
+
+        kept = self.kept.pop(key, None)
+        self.chunks[key] = None
+        if kept and kept['tiles'] is not None:
+            self.kept_size -= len(kept['tiles'])
+            shape = (self.world.depth, self.world.chunk_size, self.world.chunk_size)
+            self.world.load_chunk(cx, cy, np.frombuffer(zlib.decompress(kept['tiles']), dtype=np.uint8).reshape(shape))
+            for structure in kept['structures']:
+                self.world.structures[self.world.get_key(structure.x, structure.y, structure.z)] = structure
+            self.world.modified.add(key)
+            self.restored += 1
+            spawns = None
+        elif kept and kept.get('spilled'):
+            self.world.load_chunk(cx, cy, self.spill_file.get_chunk(cx, cy))
+            if self.restore:
+                self.restore(cx, cy, self.spill_file.get_structures(cx, cy))
+            self.world.modified.add(key)
+            self.restored += 1
+            spawns = None
+        elif self.save_file is not None and self.save_file.has_chunk(cx, cy):
+            self.world.load_chunk(cx, cy, self.save_file.get_chunk(cx, cy))
+            if self.restore:
+                self.restore(cx, cy, self.save_file.get_structures(cx, cy))
+            self.world.modified.discard(key)
+            self.unsaved.discard(key)
+            self.opened += 1
+            spawns = None
+        elif self.cache_file is not None and self.cache_file.has_chunk(cx, cy):
+            self.world.load_chunk(cx, cy, self.cache_file.get_chunk(cx, cy))
+            if self.restore:
+                self.restore(cx, cy, self.cache_file.get_structures(cx, cy))
+            self.world.modified.discard(key)
+            self.unsaved.add(key)
+            self.cached += 1
+            spawns = None
+            if kept is None:
+                kept = {'data': self.cache_file.get_entities(cx, cy)}
+        else:
+            tiles, spawns = generated or self.generate(cx, cy)
+            self.world.load_chunk(cx, cy, tiles)
+            if self.populate:
+                start = time.perf_counter()
+                self.populate(cx, cy)
+                self.populate_time += time.perf_counter() - start
+            self.world.modified.discard(key)
+            self.unsaved.add(key)
+            self.generated += 1
+
+        if self.on_load:
+            start = time.perf_counter()
+            self.on_load(cx, cy, kept['data'] if kept else None, spawns)
+            self.load_time += time.perf_counter() - start
+
+    def unload(self, cx, cy):
+        ''' Unload a chunk, keeping its tiles when they changed after it was generated '''
+        key = (cx, cy)
+        kept = {'tiles': None, 'structures': [], 'data': None}
+        if key in self.world.modified:
+            kept['tiles'] = zlib.compress(self.world.get_chunk(cx, cy).tobytes())
+            kept['structures'] = self.world.get_chunk_structures(cx, cy)
+        if self.on_unload:
+            kept['data'] = self.on_unload(cx, cy)
+        if kept['tiles'] is not None or kept['data'] is not None:
+            self.kept[key] = kept
+            self.kept_size += len(kept['tiles'] or b'')
+
+        del self.chunks[key]
+        self.world.unload_chunk(cx, cy)
+        self.unloaded += 1
+        if self.spill_file is not None and self.kept_budget is not None and self.kept_size > self.kept_budget:
+            self.spill()
+
+    def spill(self):
+        ''' Write the oldest kept tiles to the spill file until the rest take half of kept_budget '''
+        shape = (self.world.depth, self.world.chunk_size, self.world.chunk_size)
+        chunks = {}
+        for key, kept in self.kept.items():
+            if self.kept_size <= self.kept_budget // 2:
+                break
+            if kept['tiles'] is None:
+                continue
+            tiles = np.frombuffer(zlib.decompress(kept['tiles']), dtype=np.uint8).reshape(shape)
+            chunks[key] = (tiles, [self.record_structure(s) for s in kept['structures']])
+            self.kept_size -= len(kept['tiles'])
+            kept.update(tiles=None, structures=[], spilled=True)
+        self.spill_file.save(0, 'spill', self.world, chunks, [], (0, 0, 0))
+        self.spilled += len(chunks)
+
+    def is_stored(self, cx, cy):
+        ''' Whether the tiles of a chunk can be loaded without generating it '''
+        key = (cx, cy)
+        return (key in self.kept and (self.kept[key]['tiles'] is not None or self.kept[key].get('spilled'))) or \
+            any(f is not None and f.has_chunk(cx, cy) for f in (self.save_file, self.cache_file))
+
+    def on_tile_changed(self, x, y, z):
+        if x is not None:
+            self.unsaved.add((x // self.world.chunk_size, y // self.world.chunk_size))
+
+    def get_unsaved_chunks(self):
+        ''' The tile ids and tile structure records of the chunks that changed since the last save.
+            Chunks that were unloaded without changing are left out, they are generated the same way again. '''
+        shape = (self.world.depth, self.world.chunk_size, self.world.chunk_size)
+        chunks = {}
+        for key in self.unsaved:
+            kept = self.kept.get(key)
+            if key in self.chunks:
+                chunks[key] = (self.world.get_chunk(*key), [self.record_structure(s) for s in self.world.get_chunk_structures(*key)])
+            elif kept is not None and kept['tiles'] is not None:
+                chunks[key] = (np.frombuffer(zlib.decompress(kept['tiles']), dtype=np.uint8).reshape(shape), [self.record_structure(s) for s in kept['structures']])
+            elif kept is not None and kept.get('spilled'):
+                chunks[key] = (self.spill_file.get_chunk(*key), self.spill_file.get_structures(*key))
+        return chunks
+
+    def get_chunks_near(self, x, y):
+        ''' Chunks with tiles within load_radius of x, y '''
+        cs = self.world.chunk_size
+        cx0 = max((x - self.load_radius) // cs, 0)
+        cy0 = max((y - self.load_radius) // cs, 0)
+        cx1 = min((x + self.load_radius) // cs, self.world.chunks_x - 1)
+        cy1 = min((y + self.load_radius) // cs, self.world.chunks_y - 1)
+        return [(cx, cy) for cy in range(cy0, cy1 + 1) for cx in range(cx0, cx1 + 1)]
+
+    def update(self, x, y):
+        ''' Load the chunks near x, y and unload old ones when there are too many '''
+        near = self.get_chunks_near(x, y)
+
+        # Generate the new chunks in the workers when there is more than one
+        new = [k for k in near if k not in self.chunks and not self.is_stored(*k)]
+        if self.workers > 1 and len(new) > 1:
+            for (cx, cy), tiles, spawns in self.generate_many(new):
+                self.load(cx, cy, (tiles, spawns))
+
+        for cx, cy in near:
+            self.load(cx, cy)
+
+        if len(self.chunks) > self.max_chunks:
+            near = set(near)
+            for key in [k for k in self.chunks if k not in near][:len(self.chunks) - self.max_chunks]:
+                self.unload(*key)
+
+    def get_stats(self):
+        return {
+            'chunks': len(self.chunks),
+            'generated': self.generated,
+            'opened': self.opened,
+            'cached': self.cached,
+            'restored': self.restored,
+            'unloaded': self.unloaded,
+            'kept': len(self.kept),
+            'kept_size': self.kept_size,
+            'spilled': self.spilled,
+            'memory': self.world.get_memory_usage()
+        }
@@ -0,0 +1,76 @@
+# Entity Index class
+class EntityIndex:
+    ''' Spatial hash of entities.
+        Every entity is kept in a bucket for its exact cell and in one
+        for its chunk, so cell lookups are O(1) and rect queries only
+        look at the chunks the rect touches. Entities must be moved
+        through move() so the buckets stay up to date.
+        Chunk buckets are dicts so queries return entities in a
+        deterministic order. '''
+
+    def __init__(self, chunk_size=16):
+        self.chunk_size = chunk_size
+        self.cells = {}
+        self.chunks = {}
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def get_chunk_key(self, x, y, z):
+        return z, x // self.chunk_size, y // self.chunk_size
+
+    def add(self, entity):
+        self.cells.setdefault((entity.x, entity.y, entity.z), []).append(entity)
+        self.chunks.setdefault(self.get_chunk_key(entity.x, entity.y, entity.z), {})[entity] = None
+        self.count += 1
+
+    def remove(self, entity):
+        self.remove_at(entity, entity.x, entity.y, entity.z)
+
+    def remove_at(self, entity, x, y, z):
+        key = (x, y, z)
+        cell = self.cells[key]
+        cell.remove(entity)
+        if not cell:
+            del self.cells[key]
+
+        key = self.get_chunk_key(x, y, z)
+        chunk = self.chunks[key]
+        del chunk[entity]
+        if not chunk:
+            del self.chunks[key]
+        self.count -= 1
+
+    def move(self, entity, x, y, z):
+        ''' Move entity to x, y, z '''
+        self.remove(entity)
+        entity.x = x
+        entity.y = y
+        entity.z = z
+        self.add(entity)
+
+    def relocate(self, entity, old_x, old_y, old_z):
+        ''' Update the buckets of an entity that was moved from old_x, old_y, old_z without move() '''
+        self.remove_at(entity, old_x, old_y, old_z)
+        self.add(entity)
+
+    def get_at(self, x, y, z):
+        ''' Entities in the cell at x, y, z '''
+        return self.cells.get((x, y, z), ())
+
+    def is_occupied(self, x, y, z, tangible_only=True):
+        for entity in self.cells.get((x, y, z), ()):
+            if entity.tangible or not tangible_only:
+                return True
+        return False
+
+    def query_rect(self, x0, y0, x1, y1, z):
+        ''' Entities on layer z with x0 <= x < x1 and y0 <= y < y1 '''
+        found = []
+        for cy in range(y0 // self.chunk_size, (y1 - 1) // self.chunk_size + 1):
+            for cx in range(x0 // self.chunk_size, (x1 - 1) // self.chunk_size + 1):
+                for entity in self.chunks.get((z, cx, cy), ()):
+                    if x0 <= entity.x < x1 and y0 <= entity.y < y1:
+                        found.append(entity)
+        return found
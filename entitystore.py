@@ -0,0 +1,239 @@
+# Imports
+import numpy as np
+from pathfinding import WANDER
+
+# AI types
+AI_ANIMAL = 0
+AI_FAST_ANIMAL = 1
+
+
+# Get object step function
+def get_object_step(ai, behaviour, x, y, z, world, player, rng, flow_field=None):
+    ''' The dx, dy of the turn of one entity object at x, y, z, or None when it stays.
+        Draws from the random.Random rng one entity at a time, chasing and fleeing
+        entities take the step of the flow field when it has one for them. The move
+        is dropped when it leaves the world, goes into a tangible tile or into the player
+        at player, the same as in EntityStore.step. '''
+    if ai == AI_FAST_ANIMAL:
+        dy = rng.randint(-1, 1)
+        dx = rng.randint(-1, 1)
+    else:
+        m = rng.randint(-1, 1)
+        dx = 0
+        dy = 0
+        if rng.randint(0, 1):
+            dx = m
+        else:
+            dy = m
+
+    # Chase or flee the player
+    if flow_field is not None:
+        step = flow_field.get_step(x, y, z, behaviour)
+        if step is not None:
+            dx, dy = step
+
+    if world.height > y + dy > 0 and world.width > x + dx > 0 and (x + dx, y + dy, z) != tuple(player):
+        if not world.is_tangible(x + dx, y + dy, z):
+            return dx, dy
+    return None
+
+
+# Entity Store class
+class EntityStore:
+    ''' Structure of arrays storage for entities.
+        Every field is a typed array with one slot per entity, so the AI
+        of every entity can take a turn with a handful of array operations. '''
+
+    def __init__(self, capacity=1024):
+        self.count = 0
+        self.x = np.zeros(capacity, dtype=np.int32)
+        self.y = np.zeros(capacity, dtype=np.int32)
+        self.z = np.zeros(capacity, dtype=np.int32)
+        self.health = np.zeros(capacity, dtype=np.int32)
+        self.tangible = np.zeros(capacity, dtype=bool)
+        self.alive = np.zeros(capacity, dtype=bool)
+        self.ai = np.zeros(capacity, dtype=np.uint8)
+        self.behaviour = np.zeros(capacity, dtype=np.uint8)
+        self.views = {}
+        self.free = []
+
+    def grow(self, capacity):
+        for field in ('x', 'y', 'z', 'health', 'tangible', 'alive', 'ai', 'behaviour'):
+            old = getattr(self, field)
+            new = np.zeros(capacity, dtype=old.dtype)
+            new[:len(old)] = old
+            setattr(self, field, new)
+
+    def add(self, x, y, z, health, tangible, ai, behaviour=WANDER):
+        ''' Add an entity and return its index, the slots of removed entities are used again '''
+        if self.free:
+            i = self.free.pop()
+        else:
+            if self.count == len(self.x):
+                self.grow(len(self.x) * 2)
+            i = self.count
+            self.count += 1
+
+        self.x[i] = x
+        self.y[i] = y
+        self.z[i] = z
+        self.health[i] = health
+        self.tangible[i] = tangible
+        self.alive[i] = True
+        self.ai[i] = ai
+        self.behaviour[i] = behaviour
+        return i
+
+    def add_many(self, x, y, z, health, tangible, ai, behaviour=WANDER):
+        ''' Add one entity per element of the arrays, returns their indices '''
+        n = len(x)
+        if self.count + n > len(self.x):
+            self.grow(max(len(self.x) * 2, self.count + n))
+
+        indices = np.arange(self.count, self.count + n)
+        self.x[indices] = x
+        self.y[indices] = y
+        self.z[indices] = z
+        self.health[indices] = health
+        self.tangible[indices] = tangible
+        self.alive[indices] = True
+        self.ai[indices] = ai
+        self.behaviour[indices] = behaviour
+        self.count += n
+        return indices
+
+    def remove(self, i):
+        self.alive[i] = False
+        self.views.pop(i, None)
+        self.free.append(i)
+
+    def step(self, indices, world, player, rng, flow_field=None):
+        ''' Give the entities at indices one AI turn.
+            Moves are drawn all at once, entities that chase or flee the player
+            take the step of the flow field instead when it has one for them.
+            Then moves out of the world, into
+            tangible tiles, into the player or into a cell a tangible entity
+            is in are dropped. When several entities want the same cell the
+            first one gets it. Returns the indices that moved and their old x and y. '''
+
+        indices = np.asarray(indices, dtype=np.intp)
+        indices = indices[self.alive[indices]]
+        n = len(indices)
+        x = self.x[indices]
+        y = self.y[indices]
+        z = self.z[indices]
+        ai = self.ai[indices]
+
+        # Animals move one tile along one axis, fast animals one tile in any direction
+        m = rng.integers(-1, 2, n, dtype=np.int32)
+        axis = rng.integers(0, 2, n)
+        dx = np.where(axis == 1, m, 0).astype(np.int32)
+        dy = np.where(axis == 0, m, 0).astype(np.int32)
+        fast = ai == AI_FAST_ANIMAL
+        dx[fast] = rng.integers(-1, 2, np.count_nonzero(fast), dtype=np.int32)
+        dy[fast] = rng.integers(-1, 2, np.count_nonzero(fast), dtype=np.int32)
+
+        # Chase or flee the player
+        if flow_field is not None:
+            behaviour = self.behaviour[indices]
+            if behaviour.any():
+                fx, fy, follow = flow_field.get_steps(x, y, z, behaviour)
+                dx[follow] = fx[follow]
+                dy[follow] = fy[follow]
+        nx = x + dx
+        ny = y + dy
+
+        # Stay inside the world and out of the player
+        ok = (dx != 0) | (dy != 0)
+        ok &= (nx > 0) & (nx < world.width) & (ny > 0) & (ny < world.height)
+        ok &= ~((nx == player[0]) & (ny == player[1]) & (z == player[2]))
+
+        # Stay out of tangible tiles
+        candidates = np.flatnonzero(ok)
+        ok[candidates] = ~world.get_tangible(nx[candidates], ny[candidates], z[candidates])
+
+        # Stay out of cells tangible entities are in, and out of each other's way
+        solid = ok & self.tangible[indices]
+        if solid.any():
+            everyone = np.flatnonzero(self.alive[:self.count] & self.tangible[:self.count])
+            occupied = np.sort(self.get_keys(world, self.x[everyone], self.y[everyone], self.z[everyone]))
+            targets = self.get_keys(world, nx, ny, z)
+            blocked = occupied[np.minimum(np.searchsorted(occupied, targets), len(occupied) - 1)] == targets
+
+            # Sort the movers by target, the first of every run of equal targets wins
+            movers = np.flatnonzero(solid & ~blocked)
+            order = movers[np.argsort(targets[movers], kind='stable')]
+            wanted = targets[order]
+            runs = np.ones(len(order), dtype=bool)
+            runs[1:] = wanted[1:] != wanted[:-1]
+            first = np.zeros(n, dtype=bool)
+            first[order[runs]] = True
+            ok &= ~solid | first
+
+        moved = indices[ok]
+        old_x = x[ok]
+        old_y = y[ok]
+        self.x[moved] = nx[ok]
+        self.y[moved] = ny[ok]
+        return moved, old_x, old_y
+
+    def get_keys(self, world, x, y, z):
+        return (z.astype(np.int64) * world.height + y) * world.width + x
+
+
+# Entity View class
+class EntityView:
+    ''' An entity stored in an EntityStore that can be used like any other entity. '''
+
+    def __init__(self, store, index):
+        self.store = store
+        self.index = index
+        store.views[index] = self
+
+    @property
+    def x(self):
+        return int(self.store.x[self.index])
+
+    @x.setter
+    def x(self, value):
+        self.store.x[self.index] = value
+
+    @property
+    def y(self):
+        return int(self.store.y[self.index])
+
+    @y.setter
+    def y(self, value):
+        self.store.y[self.index] = value
+
+    @property
+    def z(self):
+        return int(self.store.z[self.index])
+
+    @z.setter
+    def z(self, value):
+        self.store.z[self.index] = value
+
+    @property
+    def health(self):
+        return int(self.store.health[self.index])
+
+    @health.setter
+    def health(self, value):
+        self.store.health[self.index] = value
+
+    @property
+    def tangible(self):
+        return bool(self.store.tangible[self.index])
+
+    @tangible.setter
+    def tangible(self, value):
+        self.store.tangible[self.index] = value
+
+    @property
+    def behaviour(self):
+        return int(self.store.behaviour[self.index])
+
+    @behaviour.setter
+    def behaviour(self, value):
+        self.store.behaviour[self.index] = value
@@ -0,0 +1,49 @@
+# Imports
+import pygame
+
+
+# Frame Clock class
+class FrameClock:
+    ''' Paces the main loop.
+        Frames are capped at fps, the simulation runs in fixed ticks of
+        1 / tick_rate seconds no matter how fast frames are drawn, and when
+        the game is idle the loop sleeps in pygame.event.wait until input
+        arrives or idle_timeout milliseconds pass. '''
+
+    def __init__(self, fps, tick_rate, idle_timeout, max_ticks=5):
+        self.fps = fps
+        self.tick_length = 1000.0 / tick_rate
+        self.idle_timeout = idle_timeout
+        self.max_ticks = max_ticks
+        self.clock = pygame.time.Clock()
+        self.accumulator = 0.0
+        self.last_time = pygame.time.get_ticks()
+        self.idle_frames = 0
+
+    def get_events(self, idle):
+        ''' Get the events of this frame, when idle wait for the first one '''
+        if not idle:
+            return pygame.event.get()
+
+        self.idle_frames += 1
+        event = pygame.event.wait(self.idle_timeout)
+        if event.type == pygame.NOEVENT:
+            return []
+        return [event] + pygame.event.get()
+
+    def get_ticks(self):
+        ''' How many fixed simulation ticks to run this frame '''
+        now = pygame.time.get_ticks()
+        self.accumulator = min(self.accumulator + now - self.last_time, self.tick_length * self.max_ticks)
+        self.last_time = now
+
+        ticks = int(self.accumulator // self.tick_length)
+        self.accumulator -= ticks * self.tick_length
+        return ticks
+
+    def end_frame(self):
+        ''' Sleep for what is left of this frame '''
+        return self.clock.tick(self.fps)
+
+    def get_fps(self):
+        return self.clock.get_fps()
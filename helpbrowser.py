@@ -1,28 +1,166 @@
-# Hello world example. Doesn't depend on any third party GUI framework.
+# Help browser, a CEF window that runs in its own process.
 # Tested with CEF Python v55.3+.
 
-from cefpython3 import cefpython as cef
+# Imports
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+import argparse
+import json
+import os
 import platform
+import queue
+import subprocess
 import sys
-import os
+import threading
+import time
+
+ONLINE_URL = 'https://exploregame.github.io/hbdocs/#/{0}'
+
+
+# Help Browser class
+class HelpBrowser:
+    ''' Shows help pages in a helper process that runs the CEF browser.
+        The helper is started with the first page and kept running after its
+        window is closed, so later pages open without starting CEF again.
+        Pages are sent to it as lines of JSON on its stdin, open never waits for it.
+
+        In offline mode the helper serves the hbdocs pages in docs_dir
+        instead of loading them from the website. '''
+
+    def __init__(self, offline=False, docs_dir='hbdocs'):
+        self.offline = offline
+        self.docs_dir = docs_dir
+        self.process = None
+
+    def is_running(self):
+        return self.process is not None and self.process.poll() is None
+
+    def start(self):
+        ''' Start the helper process, it loads CEF before the first page is sent '''
+        command = [sys.executable, os.path.abspath(__file__), '--serve']
+        if self.offline:
+            command += ['--offline', os.path.abspath(self.docs_dir)]
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE, universal_newlines=True)
+
+    def open(self, page, title='Help Browser'):
+        ''' Show page in the help browser, starting the helper if it is not running '''
+        for attempt in range(2):
+            if not self.is_running():
+                self.start()
+            try:
+                self.process.stdin.write(json.dumps({'page': page, 'title': title}) + '\n')
+                self.process.stdin.flush()
+                return
+            except (BrokenPipeError, OSError):
+                # The helper exited after it was checked, start it again
+                self.process = None
+
+    def close(self, timeout=1.0):
+        ''' Tell the helper to shut down CEF and exit, it is killed when it takes longer than timeout '''
+        if self.process is None:
+            return
+        try:
+            self.process.stdin.close()
+            self.process.wait(timeout)
+        except (BrokenPipeError, OSError, subprocess.TimeoutExpired):
+            self.process.kill()
+        self.process = None
+
+
+# Docs Request Handler class
+class DocsRequestHandler(SimpleHTTPRequestHandler):
+    ''' Serves the offline docs without logging every request '''
+
+    def log_message(self, format, *args):
+        pass
+
+
+# Start docs server function
+def start_docs_server(docs_dir):
+    ''' Serve docs_dir on a free local port, returns the url format of its pages '''
+    server = ThreadingHTTPServer(('127.0.0.1', 0), partial(DocsRequestHandler, directory=docs_dir))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return 'http://127.0.0.1:{0}/#/{{0}}'.format(server.server_address[1])
+
+
+# Read requests function
+def read_requests(stream, requests):
+    ''' Put every request read from stream in requests, then None when it is closed '''
+    for line in stream:
+        if line.strip():
+            requests.put(json.loads(line))
+    requests.put(None)
+
+
+# Lifespan Handler class
+class LifespanHandler:
+    ''' Forgets the browser when its window is closed '''
+
+    def __init__(self, state):
+        self.state = state
+
+    def OnBeforeClose(self, browser, **_):
+        self.state['browser'] = None
+
+
+# Serve function
+def serve(url_format):
+    ''' Run CEF and open the pages read from stdin until it is closed '''
+    from cefpython3 import cefpython as cef
+    check_versions(cef)
+    sys.excepthook = cef.ExceptHook  # To shutdown all CEF processes on error
+    cef.Initialize()
+
+    requests = queue.Queue()
+    threading.Thread(target=read_requests, args=(sys.stdin, requests), daemon=True).start()
+    state = {'browser': None}
+    running = True
+    while running:
+        while not requests.empty():
+            request = requests.get()
+            if request is None:
+                running = False
+                break
+            url = url_format.format(request['page'])
+            if state['browser'] is None:
+                state['browser'] = cef.CreateBrowserSync(url=url, window_title=request['title'])
+                state['browser'].SetClientHandler(LifespanHandler(state))
+            else:
+                state['browser'].LoadUrl(url)
+        cef.MessageLoopWork()
+        time.sleep(0.01)
+
+    if state['browser'] is not None:
+        state['browser'].CloseBrowser(True)
+    cef.Shutdown()
 
 
+# Open help document function
 def open_help_document(page, title='Help Browser'):
-    check_versions()
+    ''' Show page in a browser in this process, returns when its window is closed '''
+    from cefpython3 import cefpython as cef
+    check_versions(cef)
     sys.excepthook = cef.ExceptHook  # To shutdown all CEF processes on error
     cef.Initialize()
-    cef.CreateBrowserSync(url='https://exploregame.github.io/hbdocs/#/{0}'.format(page),
-                          window_title=title)
+    cef.CreateBrowserSync(url=ONLINE_URL.format(page), window_title=title)
     cef.MessageLoop()
     cef.Shutdown()
 
 
-def check_versions():
-    print('[hello_world.py] CEF Python {ver}'.format(ver=cef.__version__))
-    print('[hello_world.py] Python {ver} {arch}'.format(
+def check_versions(cef):
+    print('[helpbrowser.py] CEF Python {ver}'.format(ver=cef.__version__))
+    print('[helpbrowser.py] Python {ver} {arch}'.format(
           ver=platform.python_version(), arch=platform.architecture()[0]))
     assert cef.__version__ >= '55.3', 'CEF Python v55.3+ required to run this'
 
 
 if __name__ == '__main__':
-    open_help_document('index')
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='ExploreGame help browser')
+    parser.add_argument('--serve', action='store_true', help='open the pages read from stdin, one JSON object per line')
+    parser.add_argument('--offline', metavar='DOCS_DIR', help='serve the pages from DOCS_DIR instead of the website')
+    parser.add_argument('page', nargs='?', default='index')
+    args = parser.parse_args()
+    if args.serve:
+        serve(start_docs_server(args.offline) if args.offline else ONLINE_URL)
+    else:
+        open_help_document(args.page)
@@ -0,0 +1,165 @@
+# Imports
+import numpy as np
+import pygame
+
+
+# Minimap class
+class Minimap:
+    ''' An overview of the world around the player, one pixel per tile.
+        Every layer has its own overview surface of the chunks around the player.
+        A chunk is drawn into the overviews of all layers at once, with one bulk
+        pixel array write per layer, as soon as it is loaded. Changed tiles are
+        patched one pixel at a time, so switching layers only picks another surface.
+        Entity markers are drawn over the overview every time the minimap is drawn.
+
+        Colours come from colours by tile name, other tiles get the average colour of their image.
+        On the layers of the field of view fov only explored tiles are shown. '''
+
+    def __init__(self, world, size, colours, fov=None, background=(0, 0, 0), player_colour=(255, 255, 255), entity_colour=(255, 0, 0), border_colour=(128, 128, 128)):
+        self.world = world
+        self.size = size
+        self.colours = colours
+        self.fov = fov
+        self.background = background
+        self.player_colour = player_colour
+        self.entity_colour = entity_colour
+        self.border_colour = border_colour
+
+        # Tile colours by tile id, filled in when tile types are added
+        self.palette = np.zeros((256, 3), dtype=np.uint8)
+        self.tile_types = 0
+
+        # The overviews cover span x span chunks from chunk origin
+        cs = world.chunk_size
+        self.span = -(-size // cs) + 2
+        self.origin = None
+        self.overviews = [pygame.Surface((self.span * cs, self.span * cs)) for z in range(world.depth)]
+        self.drawn = set()
+        self.missing = set()
+
+        # Fog over the tiles that were not explored, by layer as (key, surface)
+        self.fog = {}
+        self.version = 0
+        world.add_listener(self.on_tile_changed)
+
+    def update_palette(self):
+        for tile_type in self.world.tile_types[self.tile_types:]:
+            colour = self.colours.get(tile_type.name)
+            if colour is None:
+                colour = pygame.transform.average_color(tile_type.image)
+            self.palette[tile_type.id] = colour[:3]
+        self.tile_types = len(self.world.tile_types)
+
+    def on_tile_changed(self, x, y, z):
+        if self.origin is None:
+            return
+        cs = self.world.chunk_size
+        if x is None:
+            # A whole layer changed, draw every chunk again
+            self.missing |= self.drawn
+            self.drawn = set()
+        elif (x // cs, y // cs) in self.drawn:
+            if len(self.world.tile_types) > self.tile_types:
+                self.update_palette()
+            ox, oy = self.origin
+            self.overviews[z].set_at((x - ox * cs, y - oy * cs), self.palette[self.world.get_tile_id(x, y, z)].tolist())
+        else:
+            return
+        self.version += 1
+
+    def center(self, x, y):
+        ''' Move the overviews so the minimap around x, y is inside them, the part that stays is kept '''
+        cs = self.world.chunk_size
+        half = self.size // 2
+        if self.origin is not None:
+            ox, oy = self.origin
+            if ox * cs <= x - half and x - half + self.size <= (ox + self.span) * cs and oy * cs <= y - half and y - half + self.size <= (oy + self.span) * cs:
+                return
+
+        origin = ((x - half) // cs - 1, (y - half) // cs - 1)
+        if self.origin is not None:
+            dx = (self.origin[0] - origin[0]) * cs
+            dy = (self.origin[1] - origin[1]) * cs
+            for overview in self.overviews:
+                overview.scroll(dx, dy)
+        self.origin = origin
+
+        chunks = set((origin[0] + i, origin[1] + j) for j in range(self.span) for i in range(self.span))
+        self.drawn &= chunks
+        self.missing = chunks - self.drawn
+        for cx, cy in self.missing:
+            rect = ((cx - origin[0]) * cs, (cy - origin[1]) * cs, cs, cs)
+            for overview in self.overviews:
+                overview.fill(self.background, rect)
+        self.fog = {}
+        self.version += 1
+
+    def update(self, x, y):
+        ''' Center on x, y and draw the chunks that were loaded since the last update '''
+        self.center(x, y)
+        loaded = [(cx, cy) for cx, cy in self.missing if 0 <= cx < self.world.chunks_x and 0 <= cy < self.world.chunks_y and self.world.is_chunk_loaded(cx, cy)]
+        if not loaded:
+            return
+        if len(self.world.tile_types) > self.tile_types:
+            self.update_palette()
+
+        cs = self.world.chunk_size
+        ox, oy = self.origin
+        for cx, cy in loaded:
+            column = self.palette[self.world.get_chunk(cx, cy)]
+            rect = ((cx - ox) * cs, (cy - oy) * cs, cs, cs)
+            for z, overview in enumerate(self.overviews):
+                pygame.surfarray.blit_array(overview.subsurface(rect), column[z].swapaxes(0, 1))
+            self.missing.discard((cx, cy))
+            self.drawn.add((cx, cy))
+        self.version += 1
+
+    def get_fog(self, z):
+        ''' The surface that hides the tiles of layer z that were not explored, None when all tiles are shown '''
+        if self.fov is None or not self.fov.applies(z):
+            return None
+        key = (self.fov.version, self.origin)
+        fog = self.fog.get(z)
+        if fog is not None and fog[0] == key:
+            return fog[1]
+
+        cs = self.world.chunk_size
+        x0, y0 = self.origin[0] * cs, self.origin[1] * cs
+        visible, explored = self.fov.get_masks(z, x0, y0, x0 + self.span * cs, y0 + self.span * cs)
+        surface = pygame.Surface((self.span * cs, self.span * cs), pygame.SRCALPHA)
+        surface.fill(self.background + (255,))
+        pygame.surfarray.pixels_alpha(surface)[:] = np.where(explored, 0, 255).astype(np.uint8).T
+        self.fog[z] = (key, surface)
+        return surface
+
+    def draw(self, surface, rect, x, y, z, entities):
+        ''' Draw the minimap around x, y on layer z into rect of surface, with a marker for every entity.
+            The border is drawn just outside of rect. '''
+        rect = pygame.Rect(rect)
+        pygame.draw.rect(surface, self.border_colour, rect.inflate(2, 2), 1)
+        cs = self.world.chunk_size
+        half = self.size // 2
+        area = pygame.Rect(x - half - self.origin[0] * cs, y - half - self.origin[1] * cs, self.size, self.size)
+        surface.blit(self.overviews[z], rect, area)
+        fog = self.get_fog(z)
+        if fog is not None:
+            surface.blit(fog, rect, area)
+
+        left = rect.left - (x - half)
+        top = rect.top - (y - half)
+        clip = surface.get_clip()
+        surface.set_clip(rect.clip(clip))
+        for e in entities:
+            if self.fov is None or self.fov.is_visible(e.x, e.y, e.z):
+                surface.fill(self.entity_colour, (left + e.x, top + e.y, 2, 2))
+        surface.fill(self.player_colour, (left + x - 1, top + y - 1, 3, 3))
+        surface.set_clip(clip)
+
+    def get_area(self, x, y, z):
+        ''' The x0, y0, x1, y1 and z of the world tiles on the minimap around x, y '''
+        half = self.size // 2
+        return x - half, y - half, x - half + self.size, y - half + self.size, z
+
+    def get_memory_usage(self):
+        ''' Bytes used by the overviews '''
+        return sum(o.get_width() * o.get_height() * o.get_bytesize() for o in self.overviews)
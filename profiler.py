@@ -0,0 +1,151 @@
+# Imports
+from collections import OrderedDict, deque
+import cProfile
+import os
+import time
+
+
+# Startup Profile class
+class StartupProfile:
+    ''' Times the phases of startup.
+        Every call to phase ends the current phase and gives the time since
+        the last call to the phase with that name. '''
+
+    def __init__(self):
+        self.phases = OrderedDict()
+        self.start = time.perf_counter()
+        self.last = self.start
+
+    def phase(self, name):
+        now = time.perf_counter()
+        self.phases[name] = self.phases.get(name, 0.0) + now - self.last
+        self.last = now
+
+    def move(self, seconds, source, target):
+        ''' Move seconds of the time of source to target, for work that was timed as part of another phase '''
+        seconds = min(seconds, self.phases.get(source, 0.0))
+        self.phases[source] = self.phases.get(source, 0.0) - seconds
+        self.phases[target] = self.phases.get(target, 0.0) + seconds
+
+    def get_total(self):
+        return self.last - self.start
+
+    def get_report(self):
+        ''' One line per phase with its time and share of the total '''
+        total = self.get_total()
+        width = max(len(name) for name in self.phases)
+        lines = ['{0}  {1:8.1f} ms  {2:5.1%}'.format(name.ljust(width), seconds * 1000, seconds / total if total else 0.0)
+                 for name, seconds in self.phases.items()]
+        lines.append('{0}  {1:8.1f} ms'.format('total'.ljust(width), total * 1000))
+        return lines
+
+
+# Frame Profile class
+class FrameProfile:
+    ''' Times the phases of frames while it is enabled.
+        The times of the last window frames are kept for every phase, for
+        rolling averages and p99. Counters hold the last value they were given.
+        Frames are only timed from the first begin_frame after it was enabled,
+        when it is disabled every call returns right away.
+
+        capture(frames, path) runs cProfile over the next frames and writes the
+        stats to path, whether the profile is enabled or not. flush writes a
+        capture that has not run all of its frames yet. '''
+
+    def __init__(self, window=120):
+        self.enabled = False
+        self.window = window
+        self.phases = OrderedDict()
+        self.counters = OrderedDict()
+        self.frame_times = deque(maxlen=window)
+        self.frame = None
+        self.start = None
+        self.last = None
+
+        # cProfile capture
+        self.profiler = None
+        self.capture_frames = 0
+        self.capture_path = None
+
+    def toggle(self):
+        self.enabled = not self.enabled
+        self.phases.clear()
+        self.counters.clear()
+        self.frame_times.clear()
+        self.frame = None
+
+    def capture(self, frames, path):
+        ''' Run cProfile over the next frames, starting with the next call to begin_frame '''
+        if self.profiler is None:
+            self.capture_frames = frames
+            self.capture_path = path
+
+    def begin_frame(self):
+        if self.capture_frames and self.profiler is None:
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        if self.enabled:
+            self.start = self.last = time.perf_counter()
+            self.frame = OrderedDict()
+
+    def phase(self, name):
+        ''' End the current phase of the frame, it took the time since the last call or begin_frame '''
+        if self.frame is not None:
+            now = time.perf_counter()
+            self.frame[name] = self.frame.get(name, 0.0) + now - self.last
+            self.last = now
+
+    def add(self, name, seconds):
+        ''' Add time measured somewhere else to a phase, it is not taken from the current phase '''
+        if self.frame is not None:
+            self.frame[name] = self.frame.get(name, 0.0) + seconds
+
+    def move(self, seconds, source, target):
+        ''' Move seconds of the time of source to target in this frame, for work that was timed as part of another phase '''
+        if self.frame is not None:
+            seconds = min(seconds, self.frame.get(source, 0.0))
+            self.frame[source] = self.frame.get(source, 0.0) - seconds
+            self.frame[target] = self.frame.get(target, 0.0) + seconds
+
+    def count(self, name, value):
+        if self.frame is not None:
+            self.counters[name] = value
+
+    def end_frame(self):
+        ''' Record the frame, returns the path of the capture when it ended with this frame '''
+        if self.enabled and self.frame is not None:
+            for name, seconds in self.frame.items():
+                if name not in self.phases:
+                    self.phases[name] = deque(maxlen=self.window)
+                self.phases[name].append(seconds)
+            for name, times in self.phases.items():
+                if name not in self.frame:
+                    times.append(0.0)
+            self.frame_times.append(time.perf_counter() - self.start)
+            self.frame = None
+
+        if self.profiler is not None:
+            self.capture_frames -= 1
+            if self.capture_frames <= 0:
+                return self.flush()
+        return None
+
+    def flush(self):
+        ''' End the running capture and write its stats, returns their path or None without a running capture '''
+        self.capture_frames = 0
+        if self.profiler is None:
+            return None
+        self.profiler.disable()
+        os.makedirs(os.path.dirname(self.capture_path) or '.', exist_ok=True)
+        self.profiler.dump_stats(self.capture_path)
+        self.profiler = None
+        return self.capture_path
+
+    def get_stats(self):
+        ''' (name, average, p99) of the frame and of every phase, in seconds '''
+        stats = []
+        for name, times in [('frame', self.frame_times)] + list(self.phases.items()):
+            if times:
+                ordered = sorted(times)
+                stats.append((name, sum(ordered) / len(ordered), ordered[-(-99 * len(ordered) // 100) - 1]))
+        return stats
@@ -0,0 +1,524 @@
+# Imports
+from collections import OrderedDict
+import time
+import numpy as np
+import pygame
+
+# When the merged dirty rects cover more than this part of the screen the whole screen is redrawn
+MAX_DIRTY_AREA = 0.5
+
+# Alpha of the fog over tiles that were explored but are not visible, unexplored tiles are not drawn
+EXPLORED_FOG_ALPHA = 160
+
+# Colour chunks are multiplied with to darken them like the fog does
+EXPLORED_SHADE = (255 - EXPLORED_FOG_ALPHA,) * 3
+
+
+# No timer function, used instead of a clock when the renderer is not timed
+def no_timer():
+    return 0.0
+
+
+# Merge rects function
+def merge_rects(rects):
+    ''' Merge the rects that overlap or touch until none do, rects that are apart stay apart '''
+    merged = []
+    for rect in rects:
+        rect = pygame.Rect(rect)
+        hits = rect.inflate(2, 2).collidelistall(merged)
+        while hits:
+            for i in reversed(hits):
+                rect.union_ip(merged.pop(i))
+            hits = rect.inflate(2, 2).collidelistall(merged)
+        merged.append(rect)
+    return merged
+
+
+# Overlay class
+class Overlay:
+    ''' Something drawn on top of the world, like the info text or a menu.
+        It is redrawn when its key or rect changes, or when the world under it is redrawn. '''
+
+    def __init__(self, name, key, rect, draw):
+        self.name = name
+        self.key = key
+        self.rect = pygame.Rect(rect)
+        self.draw = draw
+
+
+# Scaled Image Cache class
+class ScaledImageCache:
+    ''' Copies of images scaled with pygame.transform.scale, by image and size.
+        Every image is scaled once per zoom level, images that already have the size are returned as they are. '''
+
+    def __init__(self):
+        self.images = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, image, size):
+        if image.get_size() == size:
+            return image
+        key = (image, size)
+        scaled = self.images.get(key)
+        if scaled is not None:
+            self.hits += 1
+            return scaled
+
+        self.misses += 1
+        scaled = self.images[key] = pygame.transform.scale(image, size)
+        return scaled
+
+    def get_memory_usage(self):
+        ''' Bytes used by the scaled images '''
+        return sum(i.get_width() * i.get_height() * i.get_bytesize() for i in self.images.values())
+
+    def get_stats(self):
+        return {
+            'images': len(self.images),
+            'hits': self.hits,
+            'misses': self.misses,
+            'memory': self.get_memory_usage()
+        }
+
+
+# Chunk Cache class
+class ChunkCache:
+    ''' Pre-rendered surfaces of chunk_size x chunk_size tiles.
+        The least recently used chunks are dropped when there are more than max_chunks,
+        chunks are rendered again when a tile in them changes.
+        Tile images of another size than tile_width x tile_height are scaled through images.
+
+        World chunks that are not loaded are never loaded from here, their tiles are left
+        as background and the chunk is rendered again by refresh once they are loaded.
+        A darkened copy of a chunk for explored tiles is made once by get_shaded_chunk. '''
+
+    def __init__(self, world, chunk_size, tile_width, tile_height, max_chunks, background=(0, 0, 0), images=None):
+        self.world = world
+        self.images = images if images is not None else ScaledImageCache()
+        self.chunk_size = chunk_size
+        self.tile_width = tile_width
+        self.tile_height = tile_height
+        self.max_chunks = max_chunks
+        self.background = background
+        self.chunks = OrderedDict()
+        self.shaded = {}
+
+        # World chunks that were not loaded when a chunk was rendered, by chunk key
+        self.incomplete = {}
+        self.hits = 0
+        self.misses = 0
+        self.tiles_blitted = 0
+        world.add_listener(self.on_tile_changed)
+
+    def get_chunk(self, cx, cy, z):
+        key = (z, cx, cy)
+        surface = self.chunks.get(key)
+        if surface is not None:
+            self.hits += 1
+            self.chunks.move_to_end(key)
+            return surface
+
+        self.misses += 1
+        surface = self.render_chunk(cx, cy, z)
+        self.chunks[key] = surface
+        while len(self.chunks) > self.max_chunks:
+            key, old = self.chunks.popitem(last=False)
+            self.shaded.pop(key, None)
+            self.incomplete.pop(key, None)
+        return surface
+
+    def get_shaded_chunk(self, cx, cy, z):
+        ''' The chunk darkened like the fog over explored tiles, it is dropped with the chunk '''
+        surface = self.get_chunk(cx, cy, z)
+        key = (z, cx, cy)
+        shaded = self.shaded.get(key)
+        if shaded is None:
+            shaded = self.shaded[key] = surface.copy()
+            shaded.fill(EXPLORED_SHADE, special_flags=pygame.BLEND_MULT)
+        return shaded
+
+    def drop(self, key):
+        self.chunks.pop(key, None)
+        self.shaded.pop(key, None)
+        self.incomplete.pop(key, None)
+
+    def render_chunk(self, cx, cy, z):
+        ''' Draw the tiles of the loaded world chunks in a chunk into a new surface '''
+        x0 = cx * self.chunk_size
+        y0 = cy * self.chunk_size
+        x1 = min(x0 + self.chunk_size, self.world.width)
+        y1 = min(y0 + self.chunk_size, self.world.height)
+
+        surface = pygame.Surface(((x1 - x0) * self.tile_width, (y1 - y0) * self.tile_height)).convert()
+        surface.fill(self.background)
+
+        size = (self.tile_width, self.tile_height)
+        images = [self.images.get(t.image, size) for t in self.world.tile_types]
+        blits = []
+        missing = []
+        cs = self.world.chunk_size
+        for wy in range(y0 // cs, (y1 - 1) // cs + 1):
+            for wx in range(x0 // cs, (x1 - 1) // cs + 1):
+                if not self.world.is_chunk_loaded(wx, wy):
+                    missing.append((wx, wy))
+                    continue
+                ax, ay = max(x0, wx * cs), max(y0, wy * cs)
+                bx, by = min(x1, (wx + 1) * cs), min(y1, (wy + 1) * cs)
+                tiles = self.world.get_region(z, ax, ay, bx, by).tolist()
+                blits.extend((images[tile], ((ax - x0 + x) * self.tile_width, (ay - y0 + y) * self.tile_height))
+                             for y, row in enumerate(tiles) for x, tile in enumerate(row))
+        surface.blits(blits, False)
+        self.tiles_blitted += len(blits)
+        if missing:
+            self.incomplete[(z, cx, cy)] = missing
+        return surface
+
+    def refresh(self):
+        ''' Drop the chunks that were rendered with world chunks that are loaded now, returns whether any were dropped '''
+        keys = [key for key, missing in self.incomplete.items() if any(self.world.is_chunk_loaded(*k) for k in missing)]
+        for key in keys:
+            self.drop(key)
+        return bool(keys)
+
+    def on_tile_changed(self, x, y, z):
+        if x is None:
+            for key in [k for k in self.chunks if k[0] == z]:
+                self.drop(key)
+        else:
+            self.drop((z, x // self.chunk_size, y // self.chunk_size))
+
+    def clear(self):
+        self.chunks.clear()
+        self.shaded.clear()
+        self.incomplete.clear()
+
+    def get_hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def get_stats(self):
+        return {
+            'chunks': len(self.chunks),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.get_hit_rate()
+        }
+
+
+# Text Cache class
+class TextCache:
+    ''' Rendered text surfaces by font, text and colors.
+        The least recently used surfaces are dropped when there are more than max_surfaces. '''
+
+    def __init__(self, max_surfaces):
+        self.max_surfaces = max_surfaces
+        self.surfaces = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def render(self, font, text, fg, bg=None):
+        key = (font, text, tuple(fg), tuple(bg) if bg is not None else None)
+        surface = self.surfaces.get(key)
+        if surface is not None:
+            self.hits += 1
+            self.surfaces.move_to_end(key)
+            return surface
+
+        self.misses += 1
+        surface = font.render(text, 0, fg, bg)
+        self.surfaces[key] = surface
+        while len(self.surfaces) > self.max_surfaces:
+            self.surfaces.popitem(last=False)
+        return surface
+
+    def get_hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def get_stats(self):
+        return {
+            'surfaces': len(self.surfaces),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.get_hit_rate()
+        }
+
+
+# Renderer class
+class Renderer:
+    ''' Draws the world, entities and overlays straight into the screen.
+        Only the parts of the screen that changed since the last frame are
+        redrawn and passed to pygame.display.update.
+
+        Tiles are tile_width x tile_height pixels times the scale set with set_scale.
+        Every scale gets its own chunk cache, with chunks of about the same size
+        in pixels so zooming out does not blit more chunks, and images are scaled
+        once per scale through one scaled image cache. '''
+
+    def __init__(self, screen, world, tile_width, tile_height, chunk_size=16, max_chunks=32, background=(0, 0, 0)):
+        self.screen = screen
+        self.world = world
+        self.base_tile_width = tile_width
+        self.base_tile_height = tile_height
+        self.base_chunk_size = chunk_size
+        self.max_chunks = max_chunks
+        self.background = background
+        self.screen_rect = screen.get_rect()
+        self.images = ScaledImageCache()
+        self.chunk_caches = {}
+        self.scale = None
+        self.set_scale(1, 1)
+        world.add_listener(self.on_tile_changed)
+
+        # State of the last frame
+        self.camera = None
+        self.sprites = {}
+        self.overlays = {}
+        self.dirty = []
+        self.full_redraw = True
+
+        # Field of view, when it is set only the tiles and entities the player sees are drawn
+        self.fov = None
+        self.fog_key = None
+        self.fog = []
+
+        # Counters of the last frame
+        self.chunks_blitted = 0
+        self.sprites_blitted = 0
+        self.dirty_rects = 0
+
+        # Seconds spent on the world, entities, every overlay by name and the display update in the last frame,
+        # they are only measured when timed is set
+        self.timed = False
+        self.times = {}
+
+    def set_scale(self, sx, sy):
+        ''' Draw tiles sx times as wide and sy times as high as the tile size, everything is redrawn next frame '''
+        if (sx, sy) == self.scale:
+            return
+        self.scale = (sx, sy)
+        self.tile_width = max(int(round(self.base_tile_width * sx)), 1)
+        self.tile_height = max(int(round(self.base_tile_height * sy)), 1)
+
+        size = (self.tile_width, self.tile_height)
+        self.chunk_cache = self.chunk_caches.get(size)
+        if self.chunk_cache is None:
+            # Never keep fewer chunks than can be on screen at once
+            chunk_size = max(int(round(self.base_chunk_size / min(sx, sy))), 1)
+            chunks_x = -(-self.screen_rect.width // (chunk_size * self.tile_width)) + 1
+            chunks_y = -(-self.screen_rect.height // (chunk_size * self.tile_height)) + 1
+            self.chunk_cache = self.chunk_caches[size] = ChunkCache(
+                self.world, chunk_size, self.tile_width, self.tile_height,
+                max(self.max_chunks, chunks_x * chunks_y), self.background, self.images)
+        self.full_redraw = True
+
+    def get_image(self, image):
+        ''' image scaled to the tile size '''
+        return self.images.get(image, (self.tile_width, self.tile_height))
+
+    def invalidate(self, rect=None):
+        ''' Redraw rect (in screen coordinates) next frame, or everything if rect is None '''
+        if rect is None:
+            self.full_redraw = True
+        else:
+            self.dirty.append(pygame.Rect(rect))
+
+    def on_tile_changed(self, x, y, z):
+        if self.camera is None or z != self.camera[2]:
+            return
+        if x is None:
+            self.invalidate()
+        else:
+            self.invalidate(self.get_tile_rect(x, y))
+
+    def get_visible_area(self, camera):
+        ''' The x0, y0, x1, y1 and z of the world tiles on screen when the camera is at camera '''
+        x, y, z = camera
+        half_width = -(-self.screen_rect.width // (2 * self.tile_width))
+        half_height = -(-self.screen_rect.height // (2 * self.tile_height))
+        return x - half_width, y - half_height, x + half_width + 1, y + half_height + 1, z
+
+    def get_origin(self):
+        ''' Screen position of world tile 0, 0 '''
+        x, y, z = self.camera
+        return int(self.screen_rect.width / 2) - x * self.tile_width, int(self.screen_rect.height / 2) - y * self.tile_height
+
+    def get_tile_rect(self, x, y):
+        ox, oy = self.get_origin()
+        return pygame.Rect(ox + x * self.tile_width, oy + y * self.tile_height, self.tile_width, self.tile_height)
+
+    def draw_frame(self, world, camera, entities, overlays):
+        ''' Draw a frame.
+            camera is the world (x, y, z) shown in the middle of the screen,
+            entities are the entities that may be visible and overlays is
+            a list of Overlay objects in the order they are drawn. '''
+
+        self.chunks_blitted = 0
+        self.sprites_blitted = 0
+        timer = time.perf_counter if self.timed else no_timer
+        times = self.times = {'world': 0.0, 'entities': 0.0, 'flip': 0.0}
+
+        if camera != self.camera:
+            self.camera = camera
+            self.full_redraw = True
+
+        # Chunks drawn before their world chunks were loaded are drawn again
+        if self.chunk_cache.refresh():
+            self.full_redraw = True
+
+        # The fog only changes when the camera moves or the player sees something else
+        fov = self.fov if self.fov is not None and self.fov.applies(camera[2]) else None
+        fog_key = None if fov is None else (camera, fov.version, self.scale)
+        if fog_key != self.fog_key:
+            self.fog_key = fog_key
+            self.render_fog(camera)
+            self.full_redraw = True
+
+        # Find the sprites on screen
+        sprites = {}
+        ox, oy = self.get_origin()
+        tw, th = self.tile_width, self.tile_height
+        z = camera[2]
+        for e in entities:
+            if e.z == z and (fov is None or fov.is_visible(e.x, e.y, z)):
+                rect = pygame.Rect(ox + e.x * tw, oy + e.y * th, tw, th)
+                if rect.colliderect(self.screen_rect):
+                    sprites[id(e)] = (rect, self.get_image(e.image))
+
+        # Find what changed since the last frame
+        dirty = self.dirty
+        if not self.full_redraw:
+            old_sprites = self.sprites
+            for k, new in sprites.items():
+                old = old_sprites.get(k)
+                if old != new:
+                    if old:
+                        dirty.append(old[0])
+                    dirty.append(new[0])
+            for k, old in old_sprites.items():
+                if k not in sprites:
+                    dirty.append(old[0])
+
+            names = set()
+            for overlay in overlays:
+                names.add(overlay.name)
+                old = self.overlays.get(overlay.name)
+                if old is None or old.key != overlay.key or old.rect != overlay.rect:
+                    if old:
+                        dirty.append(old.rect)
+                    dirty.append(overlay.rect)
+            for name, old in self.overlays.items():
+                if name not in names:
+                    dirty.append(old.rect)
+
+        if self.full_redraw:
+            dirty = [self.screen_rect.copy()]
+        else:
+            dirty = [r.clip(self.screen_rect) for r in dirty]
+            dirty = merge_rects(r for r in dirty if r.width and r.height)
+            if sum(r.width * r.height for r in dirty) > MAX_DIRTY_AREA * self.screen_rect.width * self.screen_rect.height:
+                dirty = [self.screen_rect.copy()]
+
+        self.sprites = sprites
+        self.overlays = dict((overlay.name, overlay) for overlay in overlays)
+        self.dirty = []
+        self.full_redraw = False
+        self.dirty_rects = len(dirty)
+
+        if not dirty:
+            return
+
+        # Redraw everything under the dirty rects
+        sprite_list = list(sprites.values())
+        sprite_rects = [sprite_rect for sprite_rect, image in sprite_list]
+        for rect in dirty:
+            start = timer()
+            self.screen.set_clip(rect)
+            self.screen.fill(self.background, rect)
+            if fov is None:
+                self.draw_tiles(world, rect)
+            else:
+                self.draw_fog(rect)
+            now = timer()
+            times['world'] += now - start
+            blits = [(sprite_list[i][1], sprite_list[i][0]) for i in rect.collidelistall(sprite_rects)]
+            self.screen.blits(blits, False)
+            self.sprites_blitted += len(blits)
+            start, now = now, timer()
+            times['entities'] += now - start
+            for overlay in overlays:
+                if overlay.rect.colliderect(rect):
+                    overlay.draw()
+                    start, now = now, timer()
+                    times[overlay.name] = times.get(overlay.name, 0.0) + now - start
+        self.screen.set_clip(None)
+
+        start = timer()
+        pygame.display.update(dirty)
+        times['flip'] += timer() - start
+
+    def render_fog(self, camera):
+        ''' Find the runs of tiles in every row of every chunk on screen that are visible or explored.
+            Only these runs are blitted, visible ones from the chunk and explored ones from its darkened copy,
+            unexplored tiles and tiles outside of the world are left as background. '''
+        self.fog = []
+        if self.fog_key is None:
+            return
+
+        x0, y0, x1, y1, z = self.get_visible_area(camera)
+        visible, explored = self.fov.get_masks(z, x0, y0, x1, y1)
+
+        # Runs of the same shade, a run also starts at every chunk edge and every row ends with a -1 so runs never wrap
+        width = x1 - x0 + 1
+        cs = self.chunk_cache.chunk_size
+        columns = np.arange(x0, x1 + 1)
+        rows = np.arange(y0, y1)
+        shades = np.full((y1 - y0, width), -1, dtype=np.int8)
+        shades[:, :-1] = np.where(visible, 0, np.where(explored, 1, 2))
+        shades[:, :-1][:, (columns[:-1] < 0) | (columns[:-1] >= self.world.width)] = 2
+        shades[(rows < 0) | (rows >= self.world.height), :-1] = 2
+        edges = np.broadcast_to(columns % cs == 0, shades.shape).ravel()
+        shades = shades.ravel()
+        starts = np.flatnonzero((np.diff(shades, prepend=-2) != 0) | edges)
+        lengths = np.diff(starts, append=len(shades))
+        kinds = shades[starts]
+        drawn = (kinds == 0) | (kinds == 1)
+        ox, oy = self.get_origin()
+        tw, th = self.tile_width, self.tile_height
+        for start, length, kind in zip(starts[drawn].tolist(), lengths[drawn].tolist(), kinds[drawn].tolist()):
+            x = x0 + start % width
+            y = y0 + start // width
+            cx, cy = x // cs, y // cs
+            rect = pygame.Rect(ox + x * tw, oy + y * th, length * tw, th)
+            area = pygame.Rect((x - cx * cs) * tw, (y - cy * cs) * th, length * tw, th)
+            self.fog.append((rect, cx, cy, area, kind == 1))
+
+    def draw_fog(self, rect):
+        ''' Draw the runs of visible and explored tiles under rect '''
+        z = self.camera[2]
+        get_chunk = self.chunk_cache.get_chunk
+        get_shaded_chunk = self.chunk_cache.get_shaded_chunk
+        blits = [((get_shaded_chunk if shaded else get_chunk)(cx, cy, z), fog_rect, area)
+                 for fog_rect, cx, cy, area, shaded in self.fog if fog_rect.colliderect(rect)]
+        self.screen.blits(blits, False)
+        self.chunks_blitted += len(blits)
+
+    def draw_tiles(self, world, rect):
+        ''' Draw the world chunks under rect '''
+        ox, oy = self.get_origin()
+        z = self.camera[2]
+        chunk_width = self.chunk_cache.chunk_size * self.tile_width
+        chunk_height = self.chunk_cache.chunk_size * self.tile_height
+        chunks_x = -(-world.width // self.chunk_cache.chunk_size)
+        chunks_y = -(-world.height // self.chunk_cache.chunk_size)
+
+        cx0 = max((rect.left - ox) // chunk_width, 0)
+        cy0 = max((rect.top - oy) // chunk_height, 0)
+        cx1 = min(-((ox - rect.right) // chunk_width), chunks_x)
+        cy1 = min(-((oy - rect.bottom) // chunk_height), chunks_y)
+
+        for cy in range(cy0, cy1):
+            for cx in range(cx0, cx1):
+                self.screen.blit(self.chunk_cache.get_chunk(cx, cy, z), (ox + cx * chunk_width, oy + cy * chunk_height))
+                self.chunks_blitted += 1
@@ -0,0 +1,107 @@
+# Imports
+import hashlib
+import json
+import os
+import time
+import pygame
+
+# Version of the recording format
+RECORDING_VERSION = 1
+
+
+# Get config hash function
+def get_config_hash(config):
+    ''' Hash of the whole config, a recording only replays the same with the config it was recorded with '''
+    return hashlib.sha256(json.dumps(config, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+# Input Recorder class
+class InputRecorder:
+    ''' Records the keys that are played as turns, with the milliseconds since the recording started.
+        Everything else in a game comes from the seed, so the seed, the config
+        hash and the keys are all that is needed to play the game again. '''
+
+    def __init__(self, path, seed, config_hash, version):
+        self.path = path
+        self.seed = seed
+        self.config_hash = config_hash
+        self.version = version
+        self.start = time.perf_counter()
+        self.keys = []
+
+    def record(self, key):
+        self.keys.append((int((time.perf_counter() - self.start) * 1000), key))
+
+    def save(self, state_hash):
+        ''' Write the recording with the hash of the state the game ended in '''
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        with open(self.path, 'w') as f:
+            json.dump({
+                'format': RECORDING_VERSION,
+                'seed': self.seed,
+                'config_hash': self.config_hash,
+                'version': self.version,
+                'state_hash': state_hash,
+                'keys': self.keys
+            }, f, separators=(',', ':'))
+
+
+# Input Replay class
+class InputReplay:
+    ''' Plays a recording back as fast as possible.
+        Every frame gets the next recorded key and the game quits after the last one.
+        The time of every frame and turn is kept for the trace. '''
+
+    def __init__(self, path, trace=None):
+        self.path = path
+        self.trace = trace
+        with open(path) as f:
+            recording = json.load(f)
+        if recording['format'] != RECORDING_VERSION:
+            raise ValueError('{0} has recording format {1}, only {2} can be replayed'.format(path, recording['format'], RECORDING_VERSION))
+        self.seed = recording['seed']
+        self.config_hash = recording['config_hash']
+        self.version = recording['version']
+        self.state_hash = recording['state_hash']
+        self.keys = [key for ms, key in recording['keys']]
+        self.position = 0
+        self.frame_times = []
+        self.turn_times = []
+        self.start = time.perf_counter()
+
+    def is_done(self):
+        return self.position >= len(self.keys)
+
+    def get_events(self):
+        ''' The events of the next frame, the next key or quit when there are none left '''
+        if self.is_done():
+            return [pygame.event.Event(pygame.QUIT)]
+        self.position += 1
+        return [pygame.event.Event(pygame.KEYDOWN, key=self.keys[self.position - 1])]
+
+    def add_frame(self, seconds):
+        self.frame_times.append(seconds)
+
+    def add_turn(self, seconds):
+        self.turn_times.append(seconds)
+
+    def get_stats(self):
+        ''' Totals and the average and p99 of the frame and turn times, in seconds '''
+        stats = {'keys': len(self.keys), 'frames': len(self.frame_times), 'turns': len(self.turn_times), 'time': time.perf_counter() - self.start}
+        for name, times in (('frame', self.frame_times), ('turn', self.turn_times)):
+            ordered = sorted(times) or [0.0]
+            stats[name + '_average'] = sum(ordered) / len(ordered)
+            stats[name + '_p99'] = ordered[-(-99 * len(ordered) // 100) - 1]
+        return stats
+
+    def save_trace(self, state_hash):
+        ''' Write the frame and turn times and the state hash to the trace file as JSON '''
+        with open(self.trace, 'w') as f:
+            json.dump({
+                'recording': self.path,
+                'stats': self.get_stats(),
+                'state_hash': state_hash,
+                'matches': state_hash == self.state_hash,
+                'frame_times': self.frame_times,
+                'turn_times': self.turn_times
+            }, f)
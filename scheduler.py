@@ -0,0 +1,59 @@
+# Imports
+import time
+
+
+# Simulation Scheduler class
+class SimulationScheduler:
+    ''' Decides which entities get a turn.
+        Entities on the player's layer within radius of the player get a turn
+        every turn. Every other entity gets one catch-up turn every
+        catch_up_interval turns, a different slice of the entity list
+        each turn, so the work per turn does not grow with the world.
+        When batch_step is set it is called with every entity that gets
+        a turn instead of calling their do_turn one by one. '''
+
+    def __init__(self, radius, catch_up_interval, batch_step=None):
+        self.radius = radius
+        self.catch_up_interval = max(1, catch_up_interval)
+        self.batch_step = batch_step
+        self.turn = 0
+
+        # Metrics
+        self.active_turns = 0
+        self.catch_up_turns = 0
+        self.turn_time = 0.0
+        self.average_turn_time = 0.0
+
+    def is_active(self, entity, x, y, z):
+        return entity.z == z and abs(entity.x - x) <= self.radius and abs(entity.y - y) <= self.radius
+
+    def do_turn(self, entities, entity_index, x, y, z):
+        ''' Give the entities near x, y, z a turn and this turn's slice of the rest a catch-up turn '''
+        start = time.perf_counter()
+
+        # Pick both sets before anything moves so no entity gets two turns
+        active = entity_index.query_rect(x - self.radius, y - self.radius, x + self.radius + 1, y + self.radius + 1, z)
+        catch_up = [e for e in entities[self.turn % self.catch_up_interval::self.catch_up_interval] if not self.is_active(e, x, y, z)]
+
+        if self.batch_step:
+            self.batch_step(active + catch_up)
+        else:
+            for entity in active:
+                entity.do_turn()
+            for entity in catch_up:
+                entity.do_turn()
+
+        self.turn += 1
+        self.active_turns = len(active)
+        self.catch_up_turns = len(catch_up)
+        self.turn_time = time.perf_counter() - start
+        self.average_turn_time = self.turn_time if self.turn == 1 else self.average_turn_time * 0.9 + self.turn_time * 0.1
+
+    def get_stats(self):
+        return {
+            'turn': self.turn,
+            'active': self.active_turns,
+            'catch_up': self.catch_up_turns,
+            'turn_time': self.turn_time,
+            'average_turn_time': self.average_turn_time
+        }
@@ -0,0 +1,70 @@
+# Imports
+from worldgen import get_chunk_generator
+
+
+# Tile class
+class Tile:
+    def __init__(self, name, x, y, z, tangible, image):
+        self.name = name
+        self.x = x
+        self.y = y
+        self.z = z
+        self.tangible = tangible
+        self.image = image
+
+
+# Stairwell Tile Structure
+class StairwellTileStructure(Tile):
+    stairwell_direction = None
+
+    def setup(self, rng, depth):
+        ''' Pick the direction and return the other end of the stairwell, it is placed with this one '''
+        self.stairwell_direction = int(rng.integers(0, 2)) if self.z != depth - 1 else 0
+        d = 1 if self.stairwell_direction == 1 else -1
+        osw = StairwellTileStructure(z=self.z + d, y=self.y, x=self.x, name='stairwell', tangible=self.tangible, image=self.image)
+        osw.stairwell_direction = not self.stairwell_direction
+        return [osw]
+
+
+# Tile structure classes
+tile_structure_classes = {
+    'stairwell': StairwellTileStructure
+}
+
+
+# Create tile structure function
+def create_tile_structure(tile_structure, x, y, z, image):
+    return tile_structure_classes[tile_structure['name']](
+        name=tile_structure['tile']['name'],
+        x=x,
+        y=y,
+        z=z,
+        tangible=tile_structure['tile']['tangible'],
+        image=image
+    )
+
+
+# Place tile structures function
+def place_tile_structures(world, seed, structure_table, tile_structures, images, cx, cy):
+    ''' Place the tile structures of a chunk that was just generated.
+        The sites of a layer are sampled at once and placed with the other ends of stairwells in one write.
+        images has the image of every tile structure by tile name. '''
+    cs = world.chunk_size
+    x0, y0 = cx * cs, cy * cs
+    x1, y1 = min(x0 + cs, world.width), min(y0 + cs, world.height)
+    tiles = world.get_chunk(cx, cy)
+    chunk_random = get_chunk_generator(seed, cx, cy, 'structures')
+    for z in range(world.depth):
+        for index, tile_structure in enumerate(tile_structures):
+            ys, xs = structure_table.sample(index, tiles[z, :y1 - y0, :x1 - x0], chunk_random)
+            structures = []
+            for y, x in zip(ys.tolist(), xs.tolist()):
+                tile_structure_object = create_tile_structure(tile_structure, x0 + x, y0 + y, z, images.get(tile_structure['tile']['name']))
+                structures.append(tile_structure_object)
+                structures.extend(tile_structure_object.setup(chunk_random, world.depth))
+            world.set_structures(structures)
+
+    # FIX: Stairwell Bug
+    for structure in world.get_chunk_structures(cx, cy):
+        if structure.name == 'stairwell' and structure.z % world.depth == world.depth - 1:
+            structure.stairwell_direction = 0
@@ -0,0 +1,170 @@
+# Imports
+import numpy as np
+
+# Transforms of the eight octants for shadowcasting, as xx, xy, yx, yy
+OCTANTS = [
+    (1, 0, 0, 1), (0, 1, 1, 0), (0, -1, 1, 0), (-1, 0, 0, 1),
+    (-1, 0, 0, -1), (0, -1, -1, 0), (0, 1, -1, 0), (1, 0, 0, -1)
+]
+
+
+# Field Of View class
+class FieldOfView:
+    ''' The tiles the player can see on the layers in layers.
+        The visible tiles within radius of the player are found by recursive
+        shadowcasting over tangible tiles, once per player move and not every
+        frame. The tiles that were ever visible are explored, they are kept as
+        one packed bit per tile for every chunk with an explored tile.
+        On the other layers everything is visible. '''
+
+    def __init__(self, world, radius, layers):
+        self.world = world
+        self.radius = radius
+        self.layers = set(layers)
+        self.position = None
+        self.origin = None
+        self.visible = None
+        self.explored = {}
+        self.stale = True
+        self.version = 0
+        world.add_listener(self.on_tile_changed)
+
+    def applies(self, z):
+        return z in self.layers
+
+    def on_tile_changed(self, x, y, z):
+        if self.position is None or z != self.position[2]:
+            return
+        px, py, pz = self.position
+        if x is None or (abs(x - px) <= self.radius and abs(y - py) <= self.radius):
+            self.stale = True
+
+    def update(self, x, y, z):
+        ''' Find what the player at x, y, z sees, returns whether it changed '''
+        if not self.stale and (x, y, z) == self.position:
+            return False
+        self.position = (x, y, z)
+        self.stale = False
+        self.version += 1
+        if not self.applies(z):
+            self.visible = None
+            return True
+
+        # Tangible tiles around the player, tiles outside of the world block the view
+        r = self.radius
+        x0, y0 = x - r, y - r
+        opaque = np.ones((2 * r + 1, 2 * r + 1), dtype=bool)
+        ax, ay = max(x0, 0), max(y0, 0)
+        bx, by = min(x + r + 1, self.world.width), min(y + r + 1, self.world.height)
+        opaque[ay - y0:by - y0, ax - x0:bx - x0] = self.world.tangible[self.world.get_region(z, ax, ay, bx, by)]
+
+        self.opaque = opaque.tolist()
+        self.lit = [[False] * (2 * r + 1) for i in range(2 * r + 1)]
+        self.lit[r][r] = True
+        for xx, xy, yx, yy in OCTANTS:
+            self.cast_light(1, 1.0, 0.0, xx, xy, yx, yy)
+        visible = np.array(self.lit, dtype=bool)
+        visible[:ay - y0] = False
+        visible[by - y0:] = False
+        visible[:, :ax - x0] = False
+        visible[:, bx - x0:] = False
+        del self.opaque, self.lit
+
+        self.origin = (x0, y0)
+        self.visible = visible
+        self.explore(z, x0, y0, visible)
+        return True
+
+    def cast_light(self, row, start, end, xx, xy, yx, yy):
+        ''' Light the tiles of one octant from row on between the slopes start and end '''
+        if start < end:
+            return
+        r = self.radius
+        radius_squared = r * r
+        new_start = start
+        for j in range(row, r + 1):
+            dx, dy = -j - 1, -j
+            blocked = False
+            while dx <= 0:
+                dx += 1
+                x = r + dx * xx + dy * xy
+                y = r + dx * yx + dy * yy
+                left_slope = (dx - 0.5) / (dy + 0.5)
+                right_slope = (dx + 0.5) / (dy - 0.5)
+                if start < right_slope:
+                    continue
+                if end > left_slope:
+                    break
+                if dx * dx + dy * dy <= radius_squared:
+                    self.lit[y][x] = True
+                if blocked:
+                    if self.opaque[y][x]:
+                        new_start = right_slope
+                    else:
+                        blocked = False
+                        start = new_start
+                elif self.opaque[y][x] and j < r:
+                    blocked = True
+                    self.cast_light(j + 1, start, left_slope, xx, xy, yx, yy)
+                    new_start = right_slope
+            if blocked:
+                break
+
+    def explore(self, z, x0, y0, visible):
+        ''' Add the visible tiles to the explored bits of their chunks '''
+        cs = self.world.chunk_size
+        ys, xs = np.nonzero(visible)
+        xs = xs + x0
+        ys = ys + y0
+        for cx, cy in set(zip((xs // cs).tolist(), (ys // cs).tolist())):
+            key = (z, cx, cy)
+            bits = self.explored.get(key)
+            tiles = np.zeros((cs, cs), dtype=bool) if bits is None else np.unpackbits(bits, count=cs * cs).reshape(cs, cs).astype(bool)
+            inside = (xs // cs == cx) & (ys // cs == cy)
+            tiles[ys[inside] - cy * cs, xs[inside] - cx * cs] = True
+            self.explored[key] = np.packbits(tiles)
+
+    def is_visible(self, x, y, z):
+        if not self.applies(z):
+            return True
+        if self.visible is None or z != self.position[2]:
+            return False
+        x0, y0 = self.origin
+        size = len(self.visible)
+        return 0 <= x - x0 < size and 0 <= y - y0 < size and bool(self.visible[y - y0, x - x0])
+
+    def is_chunk_explored(self, cx, cy, z):
+        ''' Whether any tile of a chunk of the world store was explored '''
+        return not self.applies(z) or (z, cx, cy) in self.explored
+
+    def get_masks(self, z, x0, y0, x1, y1):
+        ''' Which tiles with x0 <= x < x1 and y0 <= y < y1 on layer z are visible and explored '''
+        shape = (y1 - y0, x1 - x0)
+        if not self.applies(z):
+            return np.ones(shape, dtype=bool), np.ones(shape, dtype=bool)
+
+        visible = np.zeros(shape, dtype=bool)
+        if self.visible is not None and z == self.position[2]:
+            vx0, vy0 = self.origin
+            size = len(self.visible)
+            ax, ay = max(x0, vx0), max(y0, vy0)
+            bx, by = min(x1, vx0 + size), min(y1, vy0 + size)
+            if ax < bx and ay < by:
+                visible[ay - y0:by - y0, ax - x0:bx - x0] = self.visible[ay - vy0:by - vy0, ax - vx0:bx - vx0]
+
+        explored = np.zeros(shape, dtype=bool)
+        cs = self.world.chunk_size
+        for cy in range(y0 // cs, (y1 - 1) // cs + 1):
+            for cx in range(x0 // cs, (x1 - 1) // cs + 1):
+                bits = self.explored.get((z, cx, cy))
+                if bits is None:
+                    continue
+                tiles = np.unpackbits(bits, count=cs * cs).reshape(cs, cs).astype(bool)
+                ax, ay = max(x0, cx * cs), max(y0, cy * cs)
+                bx, by = min(x1, (cx + 1) * cs), min(y1, (cy + 1) * cs)
+                explored[ay - y0:by - y0, ax - x0:bx - x0] = tiles[ay - cy * cs:by - cy * cs, ax - cx * cs:bx - cx * cs]
+        return visible, explored
+
+    def get_memory_usage(self):
+        ''' Bytes used by the explored bits '''
+        return sum(bits.nbytes for bits in self.explored.values())
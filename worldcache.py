@@ -0,0 +1,74 @@
+# Imports
+import hashlib
+import json
+import os
+from worldgen import GENERATION_VERSION
+from worldsave import FORMAT_VERSION, SaveFile
+
+
+# Get generation key function
+def get_generation_key(seed, config):
+    ''' Hash of the seed and every config value that changes what the world generator makes '''
+    world = config['world']
+    values = {
+        'format': FORMAT_VERSION,
+        'generation': GENERATION_VERSION,
+        'seed': seed,
+        'size': [world['width'], world['height'], world['depth'], world['streaming']['chunk_size']],
+        'generator': world['generator'],
+        'terrain': config['terrain'],
+        'mobs': config['mobs'],
+        'tile_structures': config['tile_structures']
+    }
+    return hashlib.sha256(json.dumps(values, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+# World Cache class
+class WorldCache:
+    ''' Generated worlds on disk, one save file per generation key.
+        A cached world holds the chunks as they were generated, with the
+        tile structures and mobs they got, and never what happened to them
+        later. When the files take more than max_size bytes the ones that
+        were used the longest ago are deleted. '''
+
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+
+    def get_path(self, key):
+        return os.path.join(self.directory, key + '.sav')
+
+    def open(self, key):
+        ''' The cached world of key, an empty save file when there is none yet '''
+        cache_file = SaveFile(self.get_path(key))
+        if cache_file.exists():
+            cache_file.open()
+            os.utime(cache_file.path)
+        return cache_file
+
+    def store(self, cache_file, seed, version, world, chunks, entities):
+        ''' Add newly generated chunks and the mobs they spawned to a cached world '''
+        cache_file.save(seed, version, world, chunks, cache_file.entities + entities, (0, 0, 0))
+        self.evict(keep=cache_file.path)
+
+    def evict(self, keep=None):
+        ''' Delete the least recently used cached worlds until they fit in max_size '''
+        files = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.endswith('.sav') and path != keep:
+                stat = os.stat(path)
+                files.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(size for mtime, size, path in files)
+        if keep is not None and os.path.exists(keep):
+            total += os.path.getsize(keep)
+
+        deleted = []
+        for mtime, size, path in sorted(files):
+            if total <= self.max_size:
+                break
+            os.remove(path)
+            total -= size
+            deleted.append(path)
+        return deleted
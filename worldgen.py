@@ -0,0 +1,332 @@
+# Imports
+import zlib
+import numpy as np
+
+# OpenSimplex constants
+STRETCH_CONSTANT3 = -1.0 / 6
+SQUISH_CONSTANT3 = 1.0 / 3
+NORM_CONSTANT3 = 103
+
+# Gradients for 3D. They approximate the directions to the
+# vertices of a rhombicuboctahedron from the center, skewed so
+# that the triangular and square facets can be inscribed inside
+# circles of the same radius.
+GRADIENTS3 = (
+    -11, 4, 4, -4, 11, 4, -4, 4, 11,
+    11, 4, 4, 4, 11, 4, 4, 4, 11,
+    -11, -4, 4, -4, -11, 4, -4, -4, 11,
+    11, -4, 4, 4, -11, 4, 4, -4, 11,
+    -11, 4, -4, -4, 11, -4, -4, 4, -11,
+    11, 4, -4, 4, 11, -4, 4, 4, -11,
+    -11, -4, -4, -4, -11, -4, -4, -4, -11,
+    11, -4, -4, 4, -11, -4, 4, -4, -11,
+)
+
+# Lattice vertices (relative to the base of a honeycomb cell) that can
+# contribute to a point inside that cell
+LATTICE_OFFSETS3 = (
+    (0, 0, 0), (1, 0, 0), (0, 1, 0), (0, 0, 1), (1, 1, 0), (1, 0, 1), (0, 1, 1), (1, 1, 1),
+    (2, 0, 0), (0, 2, 0), (0, 0, 2), (2, 1, 0), (2, 0, 1), (1, 2, 0), (0, 2, 1), (1, 0, 2), (0, 1, 2),
+    (1, -1, 0), (1, 0, -1), (-1, 1, 0), (0, 1, -1), (-1, 0, 1), (0, -1, 1),
+    (1, 1, -1), (1, -1, 1), (-1, 1, 1),
+)
+
+# Version of the tile structure and mob placement, worlds generated with another version are not the same
+GENERATION_VERSION = 2
+
+# Seeds are kept as unsigned 64 bit numbers in saves and world caches
+MAX_SEED = 2 ** 64
+
+# Rows of a layer evaluated at once, keeps the temporaries small enough to stay in cache
+BLOCK_ROWS = 32
+
+
+# Wrap a python int like a signed 64 bit int
+def _overflow(x):
+    x &= 0xFFFFFFFFFFFFFFFF
+    return x - 0x10000000000000000 if x & 0x8000000000000000 else x
+
+
+# Noise Field class
+class NoiseField:
+    ''' Vectorized OpenSimplex noise.
+        Uses the same seeded permutation as opensimplex.OpenSimplex but
+        evaluates whole coordinate grids with NumPy instead of one point per call. '''
+
+    def __init__(self, seed):
+        self.seed = seed
+
+        # Generate the permutation exactly like OpenSimplex does
+        perm = np.zeros(256, dtype=np.intp)
+        source = list(range(256))
+        seed = _overflow(seed * 6364136223846793005 + 1442695040888963407)
+        seed = _overflow(seed * 6364136223846793005 + 1442695040888963407)
+        seed = _overflow(seed * 6364136223846793005 + 1442695040888963407)
+        for i in range(255, -1, -1):
+            seed = _overflow(seed * 6364136223846793005 + 1442695040888963407)
+            r = int((seed + 31) % (i + 1))
+            if r < 0:
+                r += i + 1
+            perm[i] = source[r]
+            source[r] = source[i]
+
+        gradients = np.array(GRADIENTS3, dtype=np.float64).reshape(-1, 3)
+        self.perm = perm
+        self.perm_grad_index3 = perm % len(gradients)
+        self.gradients_x = gradients[:, 0].copy()
+        self.gradients_y = gradients[:, 1].copy()
+        self.gradients_z = gradients[:, 2].copy()
+
+    def noise3(self, x, y, z):
+        ''' Evaluate noise at every point of the broadcast x, y and z arrays '''
+        x, y, z = np.broadcast_arrays(np.asarray(x, dtype=np.float64),
+                                      np.asarray(y, dtype=np.float64),
+                                      np.asarray(z, dtype=np.float64))
+
+        # Place input coordinates on simplectic honeycomb
+        stretch_offset = (x + y + z) * STRETCH_CONSTANT3
+        xs = x + stretch_offset
+        ys = y + stretch_offset
+        zs = z + stretch_offset
+
+        # Floor to get simplectic honeycomb coordinates of rhombohedron (stretched cube) super-cell origin
+        xsb = np.floor(xs)
+        ysb = np.floor(ys)
+        zsb = np.floor(zs)
+
+        # Compute simplectic honeycomb coordinates relative to rhombohedral origin
+        xins = xs - xsb
+        yins = ys - ysb
+        zins = zs - zsb
+        squish_offset = (xins + yins + zins) * SQUISH_CONSTANT3
+
+        xsb = xsb.astype(np.intp)
+        ysb = ysb.astype(np.intp)
+        zsb = zsb.astype(np.intp)
+
+        # Sum the contributions of every vertex that can be in range, out of range ones get a zero attenuation
+        value = np.zeros(x.shape, dtype=np.float64)
+        for i, j, k in LATTICE_OFFSETS3:
+            offset = squish_offset - (i + j + k) * SQUISH_CONSTANT3
+            dx = xins - i + offset
+            dy = yins - j + offset
+            dz = zins - k + offset
+
+            attn = 2 - dx * dx - dy * dy - dz * dz
+            np.maximum(attn, 0, out=attn)
+            attn *= attn
+            attn *= attn
+
+            index = self.perm_grad_index3[(self.perm[(self.perm[(xsb + i) & 0xFF] + ysb + j) & 0xFF] + zsb + k) & 0xFF]
+            value += attn * (self.gradients_x[index] * dx + self.gradients_y[index] * dy + self.gradients_z[index] * dz)
+
+        return value / NORM_CONSTANT3
+
+    def layer(self, xs, ys, z):
+        ''' Evaluate noise over the grid made by xs and ys at depth z, returns a (len(ys), len(xs)) array '''
+        out = np.empty((len(ys), len(xs)), dtype=np.float64)
+        for r in range(0, len(ys), BLOCK_ROWS):
+            block = ys[r:r + BLOCK_ROWS]
+            out[r:r + len(block)] = self.noise3(xs[np.newaxis, :], block[:, np.newaxis], z)
+        return out
+
+
+# World Generator class
+class WorldGenerator:
+    ''' Generates the height field of each z-layer as a uint8 array. '''
+
+    def __init__(self, seed, width, height, depth, freq, octaves=1, z_multiplier=1, persistence=0.5, lacunarity=2.0):
+        self.seed = seed
+        self.width = width
+        self.height = height
+        self.depth = depth
+        self.freq = float(freq)
+        self.octaves = max(1, int(octaves))
+        self.z_multiplier = float(z_multiplier)
+        self.persistence = persistence
+        self.lacunarity = lacunarity
+        self.noise = NoiseField(seed)
+
+    @classmethod
+    def from_config(cls, seed, config):
+        generator = config['world']['generator']
+        return cls(
+            seed=seed,
+            width=config['world']['width'],
+            height=config['world']['height'],
+            depth=config['world']['depth'],
+            freq=generator['freq'],
+            octaves=generator.get('octaves', 1),
+            z_multiplier=generator.get('z-multiplier', 1),
+            persistence=generator.get('persistence', 0.5),
+            lacunarity=generator.get('lacunarity', 2.0)
+        )
+
+    def generate_layer(self, z, x0=0, y0=0, width=None, height=None):
+        ''' Generate the height field of layer z, values go from 0 to 255.
+            Pass x0, y0, width and height to only generate part of the layer,
+            the values are the same as in the same part of the whole layer. '''
+        if width is None:
+            width = self.width - x0
+        if height is None:
+            height = self.height - y0
+        xs = np.arange(x0, x0 + width, dtype=np.float64)
+        ys = np.arange(y0, y0 + height, dtype=np.float64)
+
+        # Sum the octaves, each one has a higher frequency and a lower amplitude than the last
+        total = np.zeros((height, width), dtype=np.float64)
+        amplitude = 1.0
+        frequency = 1.0 / self.freq
+        amplitudes = 0.0
+        for octave in range(self.octaves):
+            total += self.noise.layer(xs * frequency, ys * frequency, z * self.z_multiplier * frequency) * amplitude
+            amplitudes += amplitude
+            amplitude *= self.persistence
+            frequency *= self.lacunarity
+
+        return np.clip(np.floor(total / amplitudes * 127.0 + 128.0), 0, 255).astype(np.uint8)
+
+    def generate(self):
+        ''' Generate every layer, returns a (depth, height, width) array '''
+        world = np.empty((self.depth, self.height, self.width), dtype=np.uint8)
+        for z in range(self.depth):
+            world[z] = self.generate_layer(z)
+        return world
+
+
+# Format ranges function
+def format_ranges(values):
+    ''' Turn a sorted list of ints into a string like 0-4, 7, 9-12 '''
+    ranges = []
+    for v in values:
+        if ranges and ranges[-1][1] == v - 1:
+            ranges[-1][1] = v
+        else:
+            ranges.append([v, v])
+    return ', '.join(str(a) if a == b else '{0}-{1}'.format(a, b) for a, b in ranges)
+
+
+# Terrain Table class
+class TerrainTable:
+    ''' The terrain rules compiled into a 256 entry lookup table per layer.
+        A whole layer of heights is classified with one indexing operation.
+        When rules overlap the first one wins, values no rule covers
+        get the tile of the closest covered value on the same layer. '''
+
+    def __init__(self, terrain, depth, tile_type_ids):
+        self.depth = depth
+        self.lookup = np.zeros((depth, 256), dtype=np.uint8)
+        self.overlaps = []
+        self.gaps = []
+
+        for z in range(depth):
+            rule = np.full(256, -1, dtype=np.intp)
+            for i, t in enumerate(terrain):
+                if not t['minz'] <= z <= t['maxz']:
+                    continue
+                lo = max(int(t['min']), 0)
+                hi = min(int(t['max']), 255)
+                if lo > hi:
+                    continue
+
+                # Remember values another rule already covers
+                taken = rule[lo:hi + 1] >= 0
+                for v in np.flatnonzero(taken) + lo:
+                    self.overlaps.append((z, int(v), terrain[rule[v]]['name'], t['name']))
+                rule[lo:hi + 1] = np.where(taken, rule[lo:hi + 1], i)
+
+            covered = np.flatnonzero(rule >= 0)
+            missing = np.flatnonzero(rule < 0)
+            for v in missing:
+                self.gaps.append((z, int(v)))
+            if len(covered) == 0:
+                continue
+
+            # Fill gaps with the closest covered value
+            if len(missing):
+                closest = covered[np.abs(covered[np.newaxis, :] - missing[:, np.newaxis]).argmin(axis=1)]
+                rule[missing] = rule[closest]
+
+            self.lookup[z] = np.array(tile_type_ids, dtype=np.uint8)[rule]
+
+    def classify(self, heights, z):
+        ''' Turn a layer of heights into tile type ids '''
+        return self.lookup[z][heights]
+
+    def get_problems(self):
+        ''' Describe the overlaps and gaps, one line per problem and set of layers '''
+        problems = {}
+        for z, v, first, second in self.overlaps:
+            problems.setdefault(('Terrain rules {0} and {1} overlap'.format(first, second), z), []).append(v)
+        for z, v in self.gaps:
+            problems.setdefault(('No terrain rule covers', z), []).append(v)
+
+        # Group layers that have the same problem with the same values
+        layers = {}
+        for (problem, z), values in problems.items():
+            layers.setdefault((problem, format_ranges(values)), []).append(z)
+        return ['{0} values {1} on {2} {3}'.format(problem, values, 'layers' if len(zs) > 1 else 'layer', format_ranges(sorted(zs)))
+                for (problem, values), zs in sorted(layers.items())]
+
+
+# Get chunk generator function
+def get_chunk_generator(seed, cx, cy, name):
+    ''' Random numbers for one chunk, they are the same every time the chunk is generated '''
+    return np.random.default_rng([seed & 0xFFFFFFFFFFFFFFFF, cx, cy, zlib.crc32(name.encode('utf-8'))])
+
+
+# Spawn Table class
+class SpawnTable:
+    ''' The spawn chances of the mobs by tile type id.
+        Every tile a mob can spawn on gets one roll per mob, all rolls of a mob
+        in a chunk are drawn at once from the chunk's random numbers. '''
+
+    def __init__(self, seed, mobs, tile_type_ids):
+        self.seed = seed
+        self.chances = np.zeros((len(mobs), 256), dtype=np.float64)
+        for i, mob in enumerate(mobs):
+            for name, chance in mob['spawn'].items():
+                if name in tile_type_ids:
+                    # The mob used to spawn when randint(0, 100 - chance) rolled 1
+                    roll = 100 - chance
+                    self.chances[i, tile_type_ids[name]] = 1.0 / (roll + 1) if roll >= 1 else 0.0
+
+    def spawn(self, tiles, cx, cy, x0, y0):
+        ''' Roll the mobs of a chunk, tiles is a (depth, height, width) array with x0, y0 as its corner.
+            Returns a list of (mob, x, y, z) where mob is the index of the mob, ordered by z, y, x and mob. '''
+        rng = get_chunk_generator(self.seed, cx, cy, 'mobs')
+        hits = []
+        for mob, chances in enumerate(self.chances):
+            if chances.any():
+                z, y, x = np.nonzero(rng.random(tiles.shape) < chances[tiles])
+                hits.append((z, y, x, np.full(len(z), mob)))
+        if not hits:
+            return []
+
+        z, y, x, mob = (np.concatenate(a) for a in zip(*hits))
+        order = np.lexsort((mob, x, y, z))
+        return list(zip(mob[order].tolist(), (x[order] + x0).tolist(), (y[order] + y0).tolist(), z[order].tolist()))
+
+
+# Structure Table class
+class StructureTable:
+    ''' The placement chances of the tile structures and the tile type ids they can be placed on.
+        sample draws the rolls of a whole layer at once, tile structures placed
+        on one layer change the tiles the next layers are sampled from, so a
+        chunk is placed one layer and tile structure at a time. '''
+
+    def __init__(self, tile_structures, tile_type_ids):
+        self.chances = np.zeros(len(tile_structures), dtype=np.float64)
+        self.allowed = np.zeros((len(tile_structures), 256), dtype=bool)
+        for i, tile_structure in enumerate(tile_structures):
+            # The tile structure used to be placed when randint(1, range - chance) rolled 1
+            if tile_structure['random']['type'] == 'randint':
+                roll = tile_structure['random']['range'] - tile_structure['random']['chance']
+                self.chances[i] = 1.0 / roll if roll >= 1 else 0.0
+            for name in tile_structure['allowed_tiles']:
+                if name in tile_type_ids:
+                    self.allowed[i, tile_type_ids[name]] = True
+
+    def sample(self, index, layer, rng):
+        ''' The ys and xs of the tiles of layer that get tile structure index '''
+        return np.nonzero((rng.random(layer.shape) < self.chances[index]) & self.allowed[index][layer])
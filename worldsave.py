@@ -0,0 +1,318 @@
+# Imports
+import mmap
+import os
+import shutil
+import struct
+import numpy as np
+
+# Save file format
+MAGIC = b'EXPLSAVE'
+FORMAT_VERSION = 2
+READ_FORMAT_VERSIONS = (1, 2)
+HEADER = struct.Struct('<8sHQIIHHQ')
+HEADER_SIZE = 4096
+RECORD = struct.Struct('<iiii')
+PLAYER = struct.Struct('<iii')
+EXPLORED = struct.Struct('<iii')
+COUNT = struct.Struct('<I')
+
+
+# Pack string function
+def pack_string(s):
+    b = s.encode('utf-8')
+    return struct.pack('<H', len(b)) + b
+
+
+# Unpack string function
+def unpack_string(data, offset):
+    ''' Returns the string at offset and the offset after it '''
+    length, = struct.unpack_from('<H', data, offset)
+    return data[offset + 2:offset + 2 + length].decode('utf-8'), offset + 2 + length
+
+
+# Save File class
+class SaveFile:
+    ''' A saved world in one binary file.
+
+        The file starts with a header of HEADER_SIZE bytes: the seed, the game
+        version, the size of the world and its chunks and the tile type table.
+        After it come the chunks, every one a raw (depth, chunk_size, chunk_size)
+        block of tile ids, and last a trailer with the chunk index, the tile
+        structure and entity records, the player position and the explored bits
+        of the field of view. Saves of format 1 have no explored bits.
+
+        Chunks are read through mmap, so opening a save only reads the header and
+        the trailer and a chunk is paged in when it is loaded. Saving only writes
+        the chunks passed to save, the others keep their blocks.
+
+        A save of the same world writes the changed chunks and a new trailer to blocks
+        the saved world does not use and then writes the fixed part of the header
+        that points to them, so a save that is cut short leaves the last one as it
+        was. A new world, or a world saved with another version or other tile types,
+        is written to a copy of the file that replaces it when it is complete. A saved
+        world that is replaced by a different one is kept next to it with .bak added
+        to its name. '''
+
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+        self.map = None
+        self.seed = None
+        self.version = None
+        self.width = None
+        self.height = None
+        self.depth = None
+        self.chunk_size = None
+        self.tile_types = []
+        self.remap = None
+        self.blocks = 0
+        self.chunks = {}
+        self.structures = {}
+        self.entities = []
+        self.entities_by_chunk = None
+        self.player = None
+        self.explored = {}
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def get_block_size(self):
+        return self.depth * self.chunk_size * self.chunk_size
+
+    def open(self):
+        ''' Read the header and trailer of the file and map it '''
+        self.file = open(self.path, 'r+b')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, format_version, self.seed, self.width, self.height, self.depth, self.chunk_size, self.blocks = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC:
+            raise ValueError('{0} is not a saved world'.format(self.path))
+        if format_version not in READ_FORMAT_VERSIONS:
+            raise ValueError('{0} has save format {1}, only {2} can be read'.format(self.path, format_version, ', '.join(map(str, READ_FORMAT_VERSIONS))))
+
+        offset = HEADER.size
+        self.version, offset = unpack_string(self.map, offset)
+        count, = COUNT.unpack_from(self.map, offset)
+        offset += COUNT.size
+        self.tile_types = []
+        for i in range(count):
+            name, offset = unpack_string(self.map, offset)
+            self.tile_types.append((name, bool(self.map[offset])))
+            offset += 1
+
+        self.read_trailer(HEADER_SIZE + self.blocks * self.get_block_size(), format_version)
+
+    def use_tile_types(self, tile_type_ids):
+        ''' Change the saved tile ids to the ids the same names have in tile_type_ids when chunks are read '''
+        missing = [name for name, tangible in self.tile_types if name not in tile_type_ids]
+        if missing:
+            raise ValueError('{0} uses tile types that are not in the config: {1}'.format(self.path, ', '.join(missing)))
+        remap = np.arange(256, dtype=np.uint8)
+        remap[:len(self.tile_types)] = [tile_type_ids[name] for name, tangible in self.tile_types]
+        self.remap = None if (remap == np.arange(256)).all() else remap
+
+    def read_trailer(self, offset, format_version):
+        data = self.map
+        count, = COUNT.unpack_from(data, offset)
+        offset += COUNT.size
+        index = np.frombuffer(data, dtype='<i4', count=count * 3, offset=offset).reshape(count, 3).tolist()
+        self.chunks = dict(((cx, cy), block) for cx, cy, block in index)
+        offset += count * 12
+
+        self.structures = {}
+        count, = COUNT.unpack_from(data, offset)
+        offset += COUNT.size
+        for i in range(count):
+            name, offset = unpack_string(data, offset)
+            x, y, z, state = RECORD.unpack_from(data, offset)
+            offset += RECORD.size
+            self.structures.setdefault((x // self.chunk_size, y // self.chunk_size), []).append((name, x, y, z, state))
+
+        self.entities = []
+        count, = COUNT.unpack_from(data, offset)
+        offset += COUNT.size
+        for i in range(count):
+            name, offset = unpack_string(data, offset)
+            x, y, z, health = RECORD.unpack_from(data, offset)
+            offset += RECORD.size
+            self.entities.append((name, x, y, z, health))
+
+        self.player = PLAYER.unpack_from(data, offset)
+        offset += PLAYER.size
+        self.entities_by_chunk = None
+
+        self.explored = {}
+        if format_version >= 2:
+            count, = COUNT.unpack_from(data, offset)
+            offset += COUNT.size
+            size = -(-self.chunk_size * self.chunk_size // 8)
+            for i in range(count):
+                z, cx, cy = EXPLORED.unpack_from(data, offset)
+                offset += EXPLORED.size
+                self.explored[(z, cx, cy)] = np.frombuffer(data, dtype=np.uint8, count=size, offset=offset).copy()
+                offset += size
+
+    def close(self):
+        if self.file is not None:
+            self.map.close()
+            self.file.close()
+            self.map = None
+            self.file = None
+
+    def has_chunk(self, cx, cy):
+        return (cx, cy) in self.chunks
+
+    def get_chunk(self, cx, cy):
+        ''' The tile ids of a saved chunk, read straight from the mapped file '''
+        block = self.chunks[(cx, cy)]
+        tiles = np.frombuffer(self.map, dtype=np.uint8, count=self.get_block_size(), offset=HEADER_SIZE + block * self.get_block_size())
+        tiles = tiles.reshape(self.depth, self.chunk_size, self.chunk_size)
+        if self.remap is not None:
+            return self.remap[tiles]
+        return tiles
+
+    def get_structures(self, cx, cy):
+        ''' (name, x, y, z, state) of the tile structures in a saved chunk '''
+        return self.structures.get((cx, cy), [])
+
+    def get_entities(self, cx, cy):
+        ''' (name, x, y, z, health) of the entities saved in a chunk '''
+        if self.entities_by_chunk is None:
+            self.entities_by_chunk = {}
+            for record in self.entities:
+                self.entities_by_chunk.setdefault((record[1] // self.chunk_size, record[2] // self.chunk_size), []).append(record)
+        return self.entities_by_chunk.get((cx, cy), [])
+
+    def save(self, seed, version, world, chunks, entities, player, explored=None):
+        ''' Write the world to the file.
+            chunks maps the cx, cy of every chunk that changed since the last save to its tile ids and
+            the (name, x, y, z, state) of its tile structures. entities is a list of (name, x, y, z, health)
+            of every entity and player is the x, y, z of the player. explored maps the z, cx, cy of chunks
+            with explored tiles to their packed explored bits. '''
+        same_world = self.file is not None and (self.seed, self.width, self.height, self.depth, self.chunk_size) == \
+            (seed, world.width, world.height, world.depth, world.chunk_size)
+        tile_types = [(t.name, bool(t.tangible)) for t in world.tile_types]
+        explored = dict(explored or {})
+        if same_world and self.remap is None and (self.version, self.tile_types) == (version, tile_types):
+            self.save_changes(chunks, entities, player, explored)
+        else:
+            self.save_copy(seed, version, world, chunks, entities, player, explored, same_world)
+
+        self.entities = list(entities)
+        self.entities_by_chunk = None
+        self.player = tuple(player)
+        self.explored = explored
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def save_changes(self, chunks, entities, player, explored):
+        ''' Write the changed chunks and a new trailer to space the saved world does not use, then switch
+            to them by writing the fixed part of the header. Nothing the saved world uses is written over
+            before the header is, so a save that is cut short leaves the last one as it was. '''
+        block_size = self.get_block_size()
+        old_offset = HEADER_SIZE + self.blocks * block_size
+        old_end = max(os.fstat(self.file.fileno()).st_size, old_offset)
+        self.map.close()
+        self.map = None
+
+        # Changed chunks go to blocks no chunk uses, then to new blocks after the old trailer
+        free = sorted(set(range(self.blocks)) - set(self.chunks.values()), reverse=True)
+        next_block = -(-(old_end - HEADER_SIZE) // block_size)
+        index = dict(self.chunks)
+        for key, (tiles, structures) in chunks.items():
+            if free:
+                index[key] = free.pop()
+            else:
+                index[key] = next_block
+                next_block += 1
+            self.file.seek(HEADER_SIZE + index[key] * block_size)
+            self.file.write(np.ascontiguousarray(tiles, dtype=np.uint8).tobytes())
+            self.structures[key] = list(structures)
+
+        # The trailer goes after the last used block when it fits in front of the old one, else after the old one
+        trailer = self.pack_trailer(index, entities, player, explored)
+        blocks = max(index.values(), default=-1) + 1
+        if HEADER_SIZE + blocks * block_size + len(trailer) > old_offset:
+            blocks = max(blocks, next_block)
+        self.file.seek(HEADER_SIZE + blocks * block_size)
+        self.file.write(trailer)
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+        self.file.seek(0)
+        self.file.write(HEADER.pack(MAGIC, FORMAT_VERSION, self.seed, self.width, self.height, self.depth, self.chunk_size, blocks))
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.truncate(HEADER_SIZE + blocks * block_size + len(trailer))
+        self.chunks = index
+        self.blocks = blocks
+
+    def save_copy(self, seed, version, world, chunks, entities, player, explored, same_world):
+        ''' Write the whole world to a copy of the file that replaces it when it is complete.
+            Used for a new world and when the version or the tile types changed. '''
+        temp_path = self.path + '.tmp'
+        if not same_world:
+            self.close()
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            self.file = open(temp_path, 'w+b')
+            self.seed, self.width, self.height, self.depth, self.chunk_size = seed, world.width, world.height, world.depth, world.chunk_size
+            self.blocks = 0
+            self.chunks = {}
+            self.structures = {}
+        else:
+            shutil.copyfile(self.path, temp_path)
+            file = open(temp_path, 'r+b')
+
+            # Blocks saved with other tile ids are changed to the ids of world before anything is added
+            if self.remap is not None:
+                for key, block in self.chunks.items():
+                    if key not in chunks:
+                        tiles = self.get_chunk(*key)
+                        file.seek(HEADER_SIZE + block * self.get_block_size())
+                        file.write(tiles.tobytes())
+            self.close()
+            self.file = file
+
+        # Chunks that were saved before are written over, new ones get a new block
+        block_size = self.get_block_size()
+        for key, (tiles, structures) in chunks.items():
+            if key not in self.chunks:
+                self.chunks[key] = self.blocks
+                self.blocks += 1
+            self.file.seek(HEADER_SIZE + self.chunks[key] * block_size)
+            self.file.write(np.ascontiguousarray(tiles, dtype=np.uint8).tobytes())
+            self.structures[key] = list(structures)
+
+        self.version = version
+        self.tile_types = [(t.name, bool(t.tangible)) for t in world.tile_types]
+        self.remap = None
+        header = HEADER.pack(MAGIC, FORMAT_VERSION, seed, world.width, world.height, world.depth, world.chunk_size, self.blocks)
+        header += pack_string(version) + COUNT.pack(len(self.tile_types))
+        header += b''.join(pack_string(name) + bytes([tangible]) for name, tangible in self.tile_types)
+        if len(header) > HEADER_SIZE:
+            raise ValueError('Save header is {0} bytes, it can only be {1}'.format(len(header), HEADER_SIZE))
+        self.file.seek(0)
+        self.file.write(header.ljust(HEADER_SIZE, b'\0'))
+
+        self.file.seek(HEADER_SIZE + self.blocks * block_size)
+        self.file.write(self.pack_trailer(self.chunks, entities, player, explored))
+        self.file.truncate()
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+        # Only a complete save replaces the file, a different world that was saved there is kept as a backup
+        if not same_world and os.path.exists(self.path):
+            os.replace(self.path, self.path + '.bak')
+        os.replace(temp_path, self.path)
+
+    def pack_trailer(self, index, entities, player, explored):
+        trailer = [COUNT.pack(len(index))]
+        trailer.append(np.array([(cx, cy, block) for (cx, cy), block in index.items()], dtype='<i4').tobytes())
+        structures = [s for records in self.structures.values() for s in records]
+        trailer.append(COUNT.pack(len(structures)))
+        trailer.extend(pack_string(name) + RECORD.pack(x, y, z, state) for name, x, y, z, state in structures)
+        trailer.append(COUNT.pack(len(entities)))
+        trailer.extend(pack_string(name) + RECORD.pack(x, y, z, health) for name, x, y, z, health in entities)
+        trailer.append(PLAYER.pack(*player))
+        trailer.append(COUNT.pack(len(explored)))
+        trailer.extend(EXPLORED.pack(*key) + np.ascontiguousarray(bits, dtype=np.uint8).tobytes() for key, bits in explored.items())
+        return b''.join(trailer)
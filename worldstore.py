@@ -0,0 +1,220 @@
+# Imports
+import numpy as np
+
+
+# Tile Type class
+class TileType:
+    ''' Everything tiles of the same kind share. '''
+
+    def __init__(self, id, name, tangible, image):
+        self.id = id
+        self.name = name
+        self.tangible = tangible
+        self.image = image
+
+
+# World Store class
+class WorldStore:
+    ''' Stores the world as one uint8 tile id per tile.
+        Names, tangibility and images are looked up in the tile type table,
+        special tiles (tile structures) are kept in a sparse map by position.
+
+        Tiles are kept in columns of chunk_size x chunk_size tiles on every
+        layer. Only loaded chunks take memory, they live in the slots of one
+        pool array. When a tile of a chunk that is not loaded is needed the
+        loader is called with the chunk's cx and cy, it should call load_chunk. '''
+
+    def __init__(self, width, height, depth, chunk_size=32):
+        self.width = width
+        self.height = height
+        self.depth = depth
+        self.chunk_size = chunk_size
+        self.chunks_x = -(-width // chunk_size)
+        self.chunks_y = -(-height // chunk_size)
+        self.tile_types = []
+        self.tile_type_ids = {}
+        self.tangible = np.zeros(0, dtype=bool)
+        self.structures = {}
+        self.listeners = []
+        self.loader = None
+
+        # Slot of every chunk in the pool, -1 when it is not loaded
+        self.chunk_slots = np.full((self.chunks_y, self.chunks_x), -1, dtype=np.int32)
+        self.pool = np.zeros((0, depth, chunk_size, chunk_size), dtype=np.uint8)
+        self.free_slots = []
+        self.loaded = {}
+
+        # Chunks with tiles set since they were loaded
+        self.modified = set()
+
+    def add_listener(self, listener):
+        ''' Call listener(x, y, z) when a tile changes, x and y are None when a whole layer changes '''
+        self.listeners.append(listener)
+
+    def tile_changed(self, x, y, z):
+        for listener in self.listeners:
+            listener(x, y, z)
+
+    def add_tile_type(self, name, tangible, image):
+        ''' Add a tile type to the table and return its id, adding a name twice returns the first id '''
+        if name in self.tile_type_ids:
+            return self.tile_type_ids[name]
+        if len(self.tile_types) > 255:
+            raise ValueError('Too many tile types, a world can only have 256')
+
+        tile_type = TileType(id=len(self.tile_types), name=name, tangible=tangible, image=image)
+        self.tile_types.append(tile_type)
+        self.tile_type_ids[name] = tile_type.id
+        self.tangible = np.array([t.tangible for t in self.tile_types], dtype=bool)
+        return tile_type.id
+
+    def get_tile_type(self, name):
+        return self.tile_types[self.tile_type_ids[name]]
+
+    def is_chunk_loaded(self, cx, cy):
+        return (cx, cy) in self.loaded
+
+    def load_chunk(self, cx, cy, tiles):
+        ''' Store the (depth, chunk_size, chunk_size) tile ids of a chunk '''
+        slot = self.loaded.get((cx, cy))
+        if slot is None:
+            if not self.free_slots:
+                used = len(self.pool)
+                pool = np.zeros((max(used * 2, 16),) + self.pool.shape[1:], dtype=np.uint8)
+                pool[:used] = self.pool
+                self.pool = pool
+                self.free_slots = list(range(len(pool) - 1, used - 1, -1))
+            slot = self.free_slots.pop()
+            self.chunk_slots[cy, cx] = slot
+            self.loaded[(cx, cy)] = slot
+
+        self.pool[slot] = tiles
+
+    def unload_chunk(self, cx, cy):
+        ''' Free the slot of a chunk and forget its tile structures '''
+        slot = self.loaded.pop((cx, cy))
+        self.chunk_slots[cy, cx] = -1
+        self.modified.discard((cx, cy))
+        self.free_slots.append(slot)
+        cs = self.chunk_size
+        for position in [p for p in self.structures if p[0] // cs == cx and p[1] // cs == cy]:
+            del self.structures[position]
+
+    def get_chunk(self, cx, cy):
+        ''' The (depth, chunk_size, chunk_size) tile ids of a chunk, loading it if needed '''
+        slot = self.chunk_slots[cy, cx]
+        if slot < 0:
+            if self.loader is None:
+                self.load_chunk(cx, cy, 0)
+            else:
+                self.loader(cx, cy)
+            slot = self.chunk_slots[cy, cx]
+        return self.pool[slot]
+
+    def get_chunk_structures(self, cx, cy):
+        cs = self.chunk_size
+        return [s for p, s in self.structures.items() if p[0] // cs == cx and p[1] // cs == cy]
+
+    def get_key(self, x, y, z):
+        ''' Position used as the key in the structure map, negative positions wrap around like they do in an array '''
+        return x % self.width, y % self.height, z % self.depth
+
+    def get_tile_id(self, x, y, z):
+        x, y, z = self.get_key(x, y, z)
+        cs = self.chunk_size
+        return self.get_chunk(x // cs, y // cs)[z, y % cs, x % cs]
+
+    def get_tile(self, x, y, z):
+        ''' Get the tile structure at x, y, z or the tile type if there is none '''
+        structure = self.structures.get(self.get_key(x, y, z))
+        if structure is not None:
+            return structure
+        return self.tile_types[self.get_tile_id(x, y, z)]
+
+    def get_name(self, x, y, z):
+        return self.tile_types[self.get_tile_id(x, y, z)].name
+
+    def get_image(self, x, y, z):
+        return self.tile_types[self.get_tile_id(x, y, z)].image
+
+    def is_tangible(self, x, y, z):
+        return self.tangible[self.get_tile_id(x, y, z)]
+
+    def get_tangible(self, x, y, z):
+        ''' Whether the tiles at the positions in the x, y and z arrays are tangible.
+            Tiles in chunks that are not loaded count as tangible. '''
+        cs = self.chunk_size
+        slots = self.chunk_slots[y // cs, x // cs]
+        loaded = slots >= 0
+        tangible = np.ones(len(slots), dtype=bool)
+        tangible[loaded] = self.tangible[self.pool[slots[loaded], z[loaded], y[loaded] % cs, x[loaded] % cs]]
+        return tangible
+
+    def get_region(self, z, x0, y0, x1, y1):
+        ''' Tile ids of layer z with x0 <= x < x1 and y0 <= y < y1, loading chunks if needed '''
+        region = np.empty((y1 - y0, x1 - x0), dtype=np.uint8)
+        cs = self.chunk_size
+        for cy in range(y0 // cs, (y1 - 1) // cs + 1):
+            for cx in range(x0 // cs, (x1 - 1) // cs + 1):
+                chunk = self.get_chunk(cx, cy)
+                ax, ay = max(x0, cx * cs), max(y0, cy * cs)
+                bx, by = min(x1, (cx + 1) * cs), min(y1, (cy + 1) * cs)
+                region[ay - y0:by - y0, ax - x0:bx - x0] = chunk[z, ay - cy * cs:by - cy * cs, ax - cx * cs:bx - cx * cs]
+        return region
+
+    def in_bounds(self, x, y, z):
+        return 0 <= x < self.width and 0 <= y < self.height and 0 <= z < self.depth
+
+    def set_layer(self, z, tile_ids):
+        ''' Replace a whole layer, this loads every chunk '''
+        cs = self.chunk_size
+        for cy in range(self.chunks_y):
+            for cx in range(self.chunks_x):
+                block = tile_ids[cy * cs:(cy + 1) * cs, cx * cs:(cx + 1) * cs]
+                self.get_chunk(cx, cy)[z, :block.shape[0], :block.shape[1]] = block
+        for position in [p for p in self.structures if p[2] == z]:
+            del self.structures[position]
+        self.tile_changed(None, None, z)
+
+    def set_tile_id(self, x, y, z, tile_type_id):
+        cs = self.chunk_size
+        self.get_chunk(x // cs, y // cs)[z, y % cs, x % cs] = tile_type_id
+        self.modified.add((x // cs, y // cs))
+
+    def set_tile_type(self, x, y, z, tile_type_id):
+        x, y, z = self.get_key(x, y, z)
+        self.structures.pop((x, y, z), None)
+        self.set_tile_id(x, y, z, tile_type_id)
+        self.tile_changed(x, y, z)
+
+    def set_structure(self, structure):
+        ''' Place a tile structure, its name, tangibility and image become a tile type '''
+        x, y, z = self.get_key(structure.x, structure.y, structure.z)
+        self.set_tile_id(x, y, z, self.add_tile_type(structure.name, structure.tangible, structure.image))
+        self.structures[(x, y, z)] = structure
+        self.tile_changed(x, y, z)
+
+    def set_structures(self, structures):
+        ''' Place many tile structures at once, the tile ids of each chunk are written in one go '''
+        if not structures:
+            return
+        cs = self.chunk_size
+        keys = [self.get_key(s.x, s.y, s.z) for s in structures]
+        ids = [self.add_tile_type(s.name, s.tangible, s.image) for s in structures]
+        xs, ys, zs = (np.array(a) for a in zip(*keys))
+        chunks = set(zip((xs // cs).tolist(), (ys // cs).tolist()))
+        for cx, cy in chunks:
+            self.get_chunk(cx, cy)
+
+        self.pool[self.chunk_slots[ys // cs, xs // cs], zs, ys % cs, xs % cs] = ids
+        self.structures.update(zip(keys, structures))
+        self.modified.update(chunks)
+        for x, y, z in keys:
+            self.tile_changed(x, y, z)
+
+    def get_structures(self, z=None):
+        return [s for p, s in self.structures.items() if z is None or p[2] == z]
+
+    def get_memory_usage(self):
+        ''' Bytes used by the tile id arrays '''
+        return self.pool.nbytes + self.chunk_slots.nbytes